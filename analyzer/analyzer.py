@@ -6,106 +6,149 @@ network performance and traffic metrics from the Highway Capacity Manual.
 
 Classes:
     MOEAnalyzer
+    SystemAnalyzer
 
 """
 
+import copy
+from itertools import chain
+
 from model.vehicle import Vehicle
 
 
 
 class MOEAnalyzer():
     """Class responsible for the metric calculation"""
-    def __init__(self, model, loader, pce, calculation_rate = 1, ):
+    def __init__(self, model, loader, pce, calculation_rate = 1,
+        stats = None):
 
         # basic components and configuration properties
         self.model = model
         self.loader = loader
         self.pce = pce
         self.calc_rate = calculation_rate # in seconds
+        self.stats = stats                # optional PipelineStats
 
-        self.vehicles = {}      # vehicle registry
+        self.vehicles = {}      # vehicles seen in this cycle
+        self.departed = {}      # vehicles of last cycle not seen again yet
         self.last_cycle = 0     # processing cycle
 
 
     def get_next_metrics(self):
         """Loop through timesteps as provided from loader and calculate."""
 
-        # time loop
-        for time, entries in self.loader.read():
+        # time loop, timing the loader if instrumented
+        timesteps = self.loader.read()
+        if self.stats is not None:
+            timesteps = self.stats.timed(timesteps)
+
+        for time, entries in timesteps:
 
-            # loop over vehicle entries in single timestamp and update values
-            for entry in entries:
-                self.read_entry(entry)
+            metrics = self.step(time, entries)
+            if metrics is not None:
+                yield metrics, time
 
-            # if elapsed time more that calculation period, time for new cycle
-            time_diff = time - self.last_cycle
-            if time_diff >= self.calc_rate:
 
+    def step(self, time, entries):
+        """Read a single timestep, return the metrics if a cycle ended."""
 
-                # update edges and calculate metrics for this cycle
-                self.update_counters(time_diff)
-                metrics = self.compute_metrics(time_diff)
+        # loop over vehicle entries in single timestamp and update values
+        for entry in entries:
+            self.read_entry(entry)
 
-                # prepare for next cycle
-                self.reset_counters()
-                self.update_vehicles()
-                self.last_cycle = self.last_cycle + self.calc_rate
+        stats = self.stats
+        if stats is not None:
+            stats.lap("read")
 
-                yield metrics, time
+        # if elapsed time more that calculation period, time for new cycle
+        time_diff = time - self.last_cycle
+        if time_diff >= self.calc_rate:
+
+            # update edges and calculate metrics for this cycle
+            updates = self.update_counters(time_diff)
+            if stats is not None:
+                stats.lap("update")
+            metrics = self.compute_metrics(time_diff)
+            if stats is not None:
+                stats.lap("compute")
+                vehicles = len(self.vehicles) + len(self.departed)
+
+            # prepare for next cycle
+            self.reset_counters()
+            self.update_vehicles()
+            self.last_cycle = self.last_cycle + self.calc_rate
+
+            if stats is not None:
+                stats.lap("cleanup")
+                stats.end_cycle(time, vehicles, updates)
+
+            return metrics
+
+        return None
 
 
     def read_entry(self, entry):
         """Store or update a single vehicle entry and its last state."""
 
-        # if vehicle is seen for the first time, create it
-        if entry.id not in self.vehicles.keys():
-            self.vehicles[entry.id] = Vehicle(entry, self.pce)
+        # if vehicle was already seen in this cycle, update entry
+        vehicle = self.vehicles.get(entry.id)
+        if vehicle is not None:
+            vehicle.new_entry = entry
+            return
 
-        # if vehicle was already in system, update entry
+        # if vehicle was in system last cycle, it didn't depart after all
+        vehicle = self.departed.pop(entry.id, None)
+        if vehicle is not None:
+            vehicle.new_entry = entry
+
+        # if vehicle is seen for the first time, create it
         else:
-            self.vehicles[entry.id].new_entry = entry
+            vehicle = Vehicle(entry, self.pce)
+
+        self.vehicles[entry.id] = vehicle
 
 
     def update_counters(self, time_diff):
-        """Update vehicles and distance counters in the network"""
+        """Update vehicles and distance counters in the network.
 
-        for vehicle in self.vehicles.values():
+        Returns the number of system counter updates made.
+        """
+
+        updates = 0
+
+        # vehicles seen in this cycle and vehicles that left since the last
+        for vehicle in chain(self.vehicles.values(), self.departed.values()):
 
             if vehicle.new_entry is not None:
+                edge_id = vehicle.new_entry.edge_id
 
                 # update counters for new edge
-                if vehicle.new_entry.edge_id in self.model.edges:
-                    (self.model.edge_systems[vehicle.new_entry.edge_id]
+                if edge_id in self.model.edges:
+                    (self.model.edge_systems[edge_id]
                         .update_entered(vehicle, time_diff))
+                    updates += 1
 
-                # update counters for new paths
-                for system in self.model.path_systems.values():
-                    if vehicle.new_entry.edge_id in system.edges:
-                        system.update_entered(vehicle, time_diff)
-
-                # update counters for new groups
-                for system in self.model.custom_systems.values():
-                    if vehicle.new_entry.edge_id in system.edges:
-                        system.update_entered(vehicle, time_diff)
+                # update counters for new paths and groups containing it
+                for system in self.model.system_index.get(edge_id, ()):
+                    system.update_entered(vehicle, time_diff)
+                    updates += 1
 
 
             if vehicle.last_entry is not None:
+                edge_id = vehicle.last_entry.edge_id
 
                 # update counters for previous edge
-                if vehicle.last_entry.edge_id in self.model.edges:
-                    (self.model.edge_systems[vehicle.last_entry.edge_id]
+                if edge_id in self.model.edges:
+                    (self.model.edge_systems[edge_id]
                         .update_left(vehicle))
+                    updates += 1
 
-                # update counters for previous paths
-                for system in self.model.path_systems.values():
-                    if vehicle.last_entry.edge_id in system.edges:
-                        system.update_left(vehicle)
-
-                # update counters for previous groups
-                for system in self.model.custom_systems.values():
-                    if vehicle.last_entry.edge_id in system.edges:
-                        system.update_left(vehicle)
+                # update counters for previous paths and groups containing it
+                for system in self.model.system_index.get(edge_id, ()):
+                    system.update_left(vehicle)
+                    updates += 1
 
+        return updates
 
 
     def compute_metrics(self, time_diff):
@@ -146,15 +189,89 @@ class MOEAnalyzer():
     def update_vehicles(self):
         """Cleanup vehicles not seen recently, prepare for new entries"""
 
-        # loop through copy of list for safe deletion
-        for v_id, vehicle in list(self.vehicles.items()):
-            
-            # if no new entries, delete
-            if vehicle.new_entry is None:
-                del self.vehicles[v_id]
+        # mark new entries of vehicles seen in this cycle as last
+        for vehicle in self.vehicles.values():
+            vehicle.update()
+
+        # vehicles that weren't seen are dropped, the rest have departed
+        # unless they are seen again in the next cycle
+        self.departed = self.vehicles
+        self.vehicles = {}
+
+        # NOTE: vehicle entry can be logged/backed up here if necessary
+
+
+
+class SystemAnalyzer(MOEAnalyzer):
+    """Metric calculation for a few multi-edge systems only.
+
+    Used to replay a simulation for paths or groups added to a model after
+    it was analyzed, without updating any other system. The systems are
+    copied with cleared counters, so other analyses of the same model are
+    not affected. Metrics have the usual format, with only these systems.
+    """
+    def __init__(self, model, loader, pce, calculation_rate = 1, paths = (),
+        groups = (), stats = None):
+        super().__init__(model, loader, pce, calculation_rate, stats)
 
-            # otherwise mark new entries as last
-            else:
-                self.vehicles[v_id].update()
+        self.paths = [self.get_copy(system) for system in paths]
+        self.groups = [self.get_copy(system) for system in groups]
 
-            # NOTE: vehicle entry can be logged/backed up here if necessary
\ No newline at end of file
+        # edge id -> copied systems containing it
+        self.system_index = {}
+        for system in self.paths + self.groups:
+            for edge_id in system.edges:
+                self.system_index.setdefault(edge_id, []).append(system)
+
+
+    @staticmethod
+    def get_copy(system):
+        """Copy a system with its counters cleared."""
+
+        system = copy.copy(system)
+        system.v_current = 0
+        system.v_visited = 0
+        system.total_dist = 0
+        system.total_ideal_time = 0
+
+        return system
+
+
+    def update_counters(self, time_diff):
+        """Update counters of the analyzed systems only."""
+
+        updates = 0
+
+        for vehicle in chain(self.vehicles.values(), self.departed.values()):
+
+            if vehicle.new_entry is not None:
+                for system in self.system_index.get(
+                    vehicle.new_entry.edge_id, ()):
+                    system.update_entered(vehicle, time_diff)
+                    updates += 1
+
+            if vehicle.last_entry is not None:
+                for system in self.system_index.get(
+                    vehicle.last_entry.edge_id, ()):
+                    system.update_left(vehicle)
+                    updates += 1
+
+        return updates
+
+
+    def compute_metrics(self, time_diff):
+        """Execute the MOE computation for the analyzed systems."""
+
+        if self.last_cycle != 0:
+            return ({}, {path.id: path.compute_metrics(time_diff)
+                    for path in self.paths},
+                {group.id: group.compute_metrics(time_diff)
+                    for group in self.groups})
+
+        else:
+            return {}, {}, {}
+
+
+    def reset_counters(self):
+        """Edge counters are not used, nothing to reset."""
+        pass
@@ -0,0 +1,347 @@
+"""Headless batch analysis
+
+This file contains a command-line runner that analyzes many combinations of
+networks, simulations and analysis configurations listed in a manifest,
+across a pool of worker processes, and streams the metrics of each run to a
+CSV, NDJSON, Parquet or columnar results file, without the web UI.
+
+A manifest is a JSON file like:
+
+    {"output_dir": "reports", "format": "csv", "workers": 4,
+     "cache_dir": "cache",
+     "defaults": {"obs_rate": 2, "pce": {"truck": 3.5}},
+     "runs": [
+        {"network": "ui/data/networks/kennedy.net.xml",
+         "simulations": ["ui/data/simulations/kennedy.output.xml"],
+         "configs": [{"name": "2s"}, {"name": "10s", "obs_rate": 10}],
+         "groups": {"Corridor": ["4934583#1", "4934583#2"]}}]}
+
+Every simulation of a run is analyzed with every one of its configs, which
+are merged over the defaults. Configs can set the obs_rate, the pce of each
+vehicle class, the model options (shortest_paths, max_paths, max_detour,
+max_length) and the engine ("object", "vectorized" or "aggregate").
+Relative paths are relative to the manifest. With a cache_dir, built models and parsed
+simulations are cached there, like in the UI.
+
+Output rows hold the cycle time, the kind of system (edge, path or group),
+its id and its metric values. The columns format instead writes a
+directory with a (cycle x system) array per metric, see analyzer/results.py.
+A summary of all runs is also written to runs.ndjson in the output
+directory.
+
+Functions:
+    get_jobs
+    prepare_inputs
+    run_job
+    main
+
+Usage:
+    python -m analyzer.batch manifest.json [--workers N] [--format F]
+        [--output-dir DIR]
+
+    Run it as a module from the repository root, as a script its imports
+    would find analyzer/analyzer.py instead of the analyzer package.
+
+"""
+
+import sys, os, json, csv, time, shutil, argparse, itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from model.network import RoadNetworkModel, load_cached_model
+from analyzer.loaders import XmlDataLoader, cache_simulation
+from analyzer.analyzer import MOEAnalyzer
+from analyzer.vectorized import (VectorizedMOEAnalyzer,
+    AggregateMOEAnalyzer, METRICS)
+from analyzer.results import ColumnarResultWriter
+
+# write parquet files only if pyarrow is available
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+ENGINES = {"object": MOEAnalyzer, "vectorized": VectorizedMOEAnalyzer,
+    "aggregate": AggregateMOEAnalyzer}
+FORMATS = {"csv": ".csv", "ndjson": ".ndjson", "parquet": ".parquet",
+    "columns": ".results"}
+KINDS = ("edge", "path", "group")
+COLUMNS = ("time", "kind", "system") + METRICS
+
+# same defaults as the configuration view
+DEFAULT_CONFIG = {"obs_rate": 2, "engine": "object", "shortest_paths": True,
+    "pce": {"car": 1, "moto": 0.5, "truck": 3.5, "bus": 3.5, "taxi": 1,
+        "other": 1}}
+MODEL_OPTIONS = ("shortest_paths", "max_paths", "max_detour", "max_length")
+
+PARQUET_CYCLES = 1000   # cycles written in one parquet row group
+
+
+def get_jobs(manifest, root):
+    """Expand manifest runs to one job per simulation and config.
+
+    Job names, which are also their output file names, are made of the
+    network, simulation and config names, with the job number appended to
+    names already taken, e.g. by simulations of the same name in different
+    directories.
+    """
+
+    defaults = dict(DEFAULT_CONFIG, **manifest.get("defaults", {}))
+    defaults["pce"] = dict(DEFAULT_CONFIG["pce"],
+        **manifest.get("defaults", {}).get("pce", {}))
+
+    jobs = []
+    names = set()
+    for run in manifest["runs"]:
+        simulations = run.get("simulations", run.get("simulation"))
+        if isinstance(simulations, str):
+            simulations = [simulations]
+
+        for simulation, (index, config) in itertools.product(simulations,
+            enumerate(run.get("configs", [{}]))):
+
+            config = dict(defaults, **config)
+            config["pce"] = dict(defaults["pce"], **config.get("pce", {}))
+            name = "{}__{}__{}".format(
+                os.path.basename(run["network"]).split(".")[0],
+                os.path.basename(simulation).split(".")[0],
+                config.get("name", index))
+            while name in names:
+                name = "{}__{}".format(name, len(jobs))
+            names.add(name)
+
+            jobs.append({"name": name,
+                "network": os.path.join(root, run["network"]),
+                "simulation": os.path.join(root, simulation),
+                "groups": run.get("groups", {}),
+                "config": config})
+
+    return jobs
+
+
+def get_rows(metrics, time):
+    """Flatten a cycle's metrics into output rows."""
+
+    return [(time, kind, _id, *(values[metric] for metric in METRICS))
+        for kind, systems in zip(KINDS, metrics)
+        for _id, values in systems.items()]
+
+
+def write_csv(filename, analyzer):
+    """Stream result rows to a CSV file, return the number of rows."""
+
+    results = analyzer.get_next_metrics()
+    count = 0
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for metrics, time in results:
+            rows = get_rows(metrics, time)
+            writer.writerows(rows)
+            count += len(rows)
+
+    return count
+
+
+def write_ndjson(filename, analyzer):
+    """Stream result rows to a newline-delimited JSON file."""
+
+    results = analyzer.get_next_metrics()
+    count = 0
+    with open(filename, "w") as file:
+        for metrics, time in results:
+            for row in get_rows(metrics, time):
+                file.write(json.dumps(dict(zip(COLUMNS, row))) + "\n")
+                count += 1
+
+    return count
+
+
+def write_parquet(filename, analyzer):
+    """Stream result rows to a Parquet file, a row group every few cycles."""
+
+    if pa is None:
+        raise ImportError("Writing parquet files requires pyarrow.")
+
+    results = analyzer.get_next_metrics()
+    schema = pa.schema([("time", pa.float64()), ("kind", pa.string()),
+        ("system", pa.string())] + [(metric, pa.float64())
+        for metric in METRICS])
+
+    count = 0
+    with pq.ParquetWriter(filename, schema) as writer:
+        for chunk in iter(lambda: list(itertools.islice(results,
+            PARQUET_CYCLES)), []):
+
+            rows = [row for metrics, time in chunk
+                for row in get_rows(metrics, time)]
+            columns = list(zip(*rows)) or [[]] * len(COLUMNS)
+            columns[2] = [str(_id) for _id in columns[2]]
+            writer.write_table(pa.table(dict(zip(COLUMNS, columns)),
+                schema=schema))
+            count += len(rows)
+
+    return count
+
+
+def write_columns(dirname, analyzer):
+    """Stream metric rows of all systems to a columnar results directory."""
+
+    # the vectorized engine's arrays are copied as whole rows
+    if isinstance(analyzer, VectorizedMOEAnalyzer):
+        analyzer.as_arrays = True
+
+    writer = ColumnarResultWriter.for_model(dirname, analyzer.model)
+    for _ in writer.write(analyzer.get_next_metrics()):
+        pass
+
+    return writer.cycles * writer.size
+
+
+WRITERS = {"csv": write_csv, "ndjson": write_ndjson, "parquet": write_parquet,
+    "columns": write_columns}
+
+
+def get_model_options(config):
+    """Get the model construction options of a config."""
+    return {option: config[option] for option in MODEL_OPTIONS
+        if option in config}
+
+
+def prepare_inputs(network, simulation, options, cache_dir):
+    """Build and cache a model or a simulation, in a worker.
+
+    Runs before the jobs, so that jobs sharing an input don't write its
+    cache at the same time.
+    """
+
+    if network is not None:
+        fileroot, name = os.path.split(network)
+        load_cached_model(fileroot, name, cache_dir, **dict(options))
+    if simulation is not None:
+        cache_simulation(simulation, cache_dir)
+
+
+def remove_output(filename):
+    """Remove an output file or results directory, if it exists."""
+
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+
+def run_job(job, output_dir, output_format, cache_dir = None):
+    """Analyze a single simulation and write its metrics, in a worker.
+
+    Returns a summary of the run, with the error message if it failed.
+    """
+
+    config = job["config"]
+    filename = os.path.join(output_dir, job["name"] + FORMATS[output_format])
+    summary = {"name": job["name"], "network": job["network"],
+        "simulation": job["simulation"], "config": config,
+        "output": filename}
+    start = time.perf_counter()
+
+    try:
+        # build or load the model, then add the run's custom groups
+        fileroot, name = os.path.split(job["network"])
+        options = get_model_options(config)
+        if cache_dir is not None:
+            model = load_cached_model(fileroot, name, cache_dir, **options)
+            loader = cache_simulation(job["simulation"], cache_dir)
+        else:
+            model = RoadNetworkModel(fileroot, name, **options)
+            loader = XmlDataLoader(job["simulation"])
+
+        for group_name, edges in job["groups"].items():
+            model.add_custom_system(group_name, edges)
+
+        analyzer = ENGINES[config["engine"]](model, loader, config["pce"],
+            float(config["obs_rate"]))
+
+        # write to a temporary file, so partial outputs are never left
+        summary["rows"] = WRITERS[output_format](filename + ".tmp",
+            analyzer)
+        remove_output(filename)
+        os.replace(filename + ".tmp", filename)
+        summary["status"] = "done"
+
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "{}: {}".format(type(e).__name__, e)
+        remove_output(filename + ".tmp")
+
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def main(arguments = None):
+    """Run all analyses of a manifest, return the number of failed ones."""
+
+    parser = argparse.ArgumentParser(description="Analyze the network, "
+        "simulation and configuration combinations of a manifest.")
+    parser.add_argument("manifest", help="JSON manifest file")
+    parser.add_argument("--workers", type=int, default=None,
+        help="worker processes (default: manifest value or CPU count)")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+        help="output format (default: manifest value or csv)")
+    parser.add_argument("--output-dir", default=None,
+        help="output directory (default: manifest value or 'reports')")
+    options = parser.parse_args(arguments)
+
+    with open(options.manifest) as file:
+        manifest = json.load(file)
+    root = os.path.dirname(os.path.abspath(options.manifest))
+
+    output_format = options.format or manifest.get("format", "csv")
+    if output_format == "parquet" and pa is None:
+        parser.error("writing parquet files requires pyarrow")
+    output_dir = os.path.join(root, options.output_dir
+        or manifest.get("output_dir", "reports"))
+    cache_dir = (os.path.join(root, manifest["cache_dir"])
+        if "cache_dir" in manifest else None)
+    workers = options.workers or manifest.get("workers")
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = get_jobs(manifest, root)
+    failed = 0
+
+    # log each run as it finishes, in a summary file and on stderr
+    with ProcessPoolExecutor(workers) as executor, open(os.path.join(
+        output_dir, "runs.ndjson"), "w") as summaries:
+
+        # cache every distinct model and simulation once, then run jobs
+        if cache_dir is not None:
+            inputs = ({(job["network"], tuple(sorted(get_model_options(
+                    job["config"]).items())), None) for job in jobs}
+                | {(None, (), job["simulation"]) for job in jobs})
+            for future in [executor.submit(prepare_inputs, network,
+                simulation, options, cache_dir)
+                for network, options, simulation in inputs]:
+                try:
+                    future.result()
+                except Exception:
+                    pass    # reported by the jobs using the input
+
+        futures = [executor.submit(run_job, job, output_dir, output_format,
+            cache_dir) for job in jobs]
+
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.write(json.dumps(summary) + "\n")
+            summaries.flush()
+
+            failed += summary["status"] != "done"
+            print("{:<8} {:8.2f} s  {}{}".format(summary["status"],
+                summary["seconds"], summary["name"],
+                "  " + summary["error"] if "error" in summary else ""),
+                file=sys.stderr)
+
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -6,49 +6,654 @@ vehicle entry data for various different data formats
 
 Classes:
     XmlDataLoader
+    ColumnarDataLoader
+    LiveDataLoader
+    SocketDataLoader
+    TailDataLoader
+    ProbeDataLoader
+
+Functions:
+    cache_simulation
 
 """
 
 import xml.etree.ElementTree as ET
+import numpy as np
+import sys, os, csv, json, shutil, hashlib, tempfile
+import itertools
+import abc
+import socket, threading, queue
+from array import array
 from model.vehicle import Entry
 
 
+# version of the columnar cache layout, caches of other versions are rebuilt
+CACHE_VERSION = 2
+
+
 class XmlDataLoader():
-    """Initialize data loading from an xml file and return an iterator."""
+    """Initialize data loading from an xml file and return an iterator.
+
+    The file is fed to the parser in chunks, with the loader as its target,
+    so vehicle entries are created directly from the attributes of each
+    element without building an element tree. Only element starts are
+    handled, a timestep is complete once the next one starts.
+    """
+
+    CHUNK_SIZE = 1 << 20    # bytes fed to the parser at once
+
     def __init__(self, filename):
 
-        # parse xml file iteratively and get root element
-        self.file = open(filename)
-        self.context = ET.iterparse(self.file,events=('start','end'))
-        self.context = iter(self.context)
-        _, self.root = self.context.__next__()
+        self.filename = filename
+        self.lanes = {}         # lane -> edge id and lane index, split once
+        self.time = None        # time of the timestep being parsed
+        self.entries = None
+        self.timesteps = []     # complete timesteps not yet read
 
 
-    
     def read(self):
         """Read all the entries in a single timestamp and clean buffer."""
 
-        # iterate through xml elements
-        for event, elem in self.context:
-            
+        parser = ET.XMLParser(target=self)
+        self.time = None
+        self.entries = None
+
+        with open(self.filename, 'rb') as file:
+            while True:
+                chunk = file.read(self.CHUNK_SIZE)
+
+                try:
+                    if chunk:
+                        parser.feed(chunk)
+                    else:
+                        parser.close()
+
+                # Read error checking
+                except ET.ParseError as e:
+                    print("Problem while reading xml file.\n", e)
+                    return
+
+                # yield the timesteps completed by this chunk
+                timesteps, self.timesteps = self.timesteps, []
+                yield from timesteps
+
+                if not chunk:
+                    return
+
+
+    def start(self, tag, attrib):
+        """Parser callback, start a timestep or store a vehicle entry."""
+
+        if tag == 'timestep':
+            if self.entries is not None:
+                self.timesteps.append((self.time, self.entries))
+            self.time = float(attrib['time'])
+            self.entries = []
+
+        elif self.entries is not None:
+
+            # split lane to edge id and lane index only once per lane
+            lane = attrib['lane']
+            if lane not in self.lanes:
+                edge_id, _, lane_id = lane.rpartition('_')
+                self.lanes[lane] = (sys.intern(edge_id), lane_id)
+            edge_id, lane_id = self.lanes[lane]
+
+            self.entries.append(Entry.from_values(sys.intern(attrib['id']),
+                sys.intern(attrib['type']), self.time, edge_id, lane_id,
+                float(attrib['pos']), float(attrib['speed'])))
+
+
+    def close(self):
+        """Parser callback, complete the last timestep."""
+
+        if self.entries is not None:
+            self.timesteps.append((self.time, self.entries))
+            self.entries = None
+
+
+
+class ColumnarDataLoader():
+    """Initialize data loading from a columnar cache, return an iterator.
+
+    The cache is a directory of NumPy arrays, loaded as memory maps: the
+    time of each timestep and the offset of its first entry, then per entry
+    the vehicle id, vehicle type, edge and lane codes plus position and
+    speed. Codes index the string tables stored alongside them. A window
+    of timestep indices can be given to only read part of the simulation.
+    """
+
+    COLUMNS = {'vehicles': 'i4', 'types': 'i2', 'edges': 'i4', 'lanes': 'i2',
+        'pos': 'f8', 'speed': 'f8'}
+
+    # string table of each code column, with the entry attribute it encodes
+    TABLES = {'vehicle_ids': ('vehicles', 'id'), 'type_ids': ('types', 'type'),
+        'edge_ids': ('edges', 'edge_id'), 'lane_ids': ('lanes', 'lane_id')}
+
+    BLOCK_SIZE = 65536  # entries converted from the mapped columns at once
+
+
+    def __init__(self, dirname, start=None, stop=None):
+
+        # map numeric arrays, load small string tables to memory
+        self.dirname = dirname
+        times = self.load('times')
+
+        # keep only the timesteps in the window, offsets are absolute
+        self.start, self.stop, _ = slice(start, stop).indices(len(times))
+        self.times = times[self.start:self.stop]
+        self.offsets = self.load('offsets')[self.start:self.stop + 1]
+        self.columns = {name: self.load(name) for name in self.COLUMNS}
+        self.tables = {name: self.load(name).tolist() for name in self.TABLES}
+
+
+    def load(self, name):
+        """Memory map a single stored array."""
+        return np.load(os.path.join(self.dirname, name + '.npy'),
+            mmap_mode='r')
+
+
+    def read(self):
+        """Read all the entries in a single timestamp from the columns."""
+
+        vehicle_ids, type_ids, edge_ids, lane_ids = (self.tables[name]
+            for name in self.TABLES)
+        times = self.times.tolist()
+        offsets = self.offsets.tolist()
+
+        # convert columns to lists a block of timesteps at a time, slicing
+        # mapped arrays for every single timestep is slower than the parsing
+        block_start = 0
+        while block_start < len(times):
+            block_end = block_start + 1
+            while (block_end < len(times) and offsets[block_end]
+                - offsets[block_start] < self.BLOCK_SIZE):
+                block_end += 1
+
+            base = offsets[block_start]
+            vehicles, types, edges, lanes, pos, speed = (
+                self.columns[name][base:offsets[block_end]].tolist()
+                for name in self.COLUMNS)
+            rows = list(zip(vehicles, types, edges, lanes, pos, speed))
+
+            # yield each timestep of the block
+            for index in range(block_start, block_end):
+                time = times[index]
+                entries = [Entry.from_values(vehicle_ids[v], type_ids[t], time,
+                        edge_ids[e], lane_ids[l], p, s)
+                    for v, t, e, l, p, s
+                    in rows[offsets[index]-base:offsets[index+1]-base]]
+
+                yield time, entries
+
+            block_start = block_end
+
+
+    @classmethod
+    def write(cls, loader, dirname):
+        """Read all timesteps from a loader and store them as columns."""
+
+        os.makedirs(dirname, exist_ok=True)
+
+        # typed buffers for timesteps and entry columns
+        times, offsets = array('d'), array('q', [0])
+        columns = {name: array('d' if dtype == 'f8' else 'q')
+            for name, dtype in cls.COLUMNS.items()}
+
+        # string tables, codes are assigned in order of first appearance
+        tables = {name: {} for name in cls.TABLES}
+
+        for time, entries in loader.read():
+            times.append(time)
+
+            for entry in entries:
+                for name, (column, attribute) in cls.TABLES.items():
+                    codes = tables[name]
+                    value = getattr(entry, attribute)
+                    columns[column].append(codes.setdefault(value, len(codes)))
+
+                columns['pos'].append(entry.pos)
+                columns['speed'].append(entry.speed)
+
+            offsets.append(len(columns['pos']))
+
+        # store all arrays with their final types
+        np.save(os.path.join(dirname, 'times.npy'), np.array(times))
+        np.save(os.path.join(dirname, 'offsets.npy'), np.array(offsets))
+        for name, dtype in cls.COLUMNS.items():
+            np.save(os.path.join(dirname, name + '.npy'),
+                np.array(columns[name], dtype=dtype))
+        for name, codes in tables.items():
+            np.save(os.path.join(dirname, name + '.npy'),
+                np.array(list(codes), dtype=str))
+
+        return cls(dirname)
+
+
+
+def cache_simulation(filename, cache_dir, loader_class=XmlDataLoader):
+    """Get a columnar loader for a simulation file, converting it if needed.
+
+    The cache is reused as long as the size and modification time of the
+    simulation file, and the cache layout version, are the same as when it
+    was converted. Caches are keyed by the hash of the file's absolute path,
+    so files of the same name in different directories don't share one.
+    """
+
+    digest = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()
+    dirname = os.path.join(cache_dir, '{}.{}.cols'.format(
+        os.path.basename(filename), digest[:16]))
+    stat = os.stat(filename)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime,
+        'version': CACHE_VERSION}
+
+    # reuse existing cache if it was built from this exact file
+    if get_cache_source(dirname) == source:
+        return ColumnarDataLoader(dirname)
+
+    # otherwise parse the file once into a temporary directory and move it
+    # into place, so concurrent requests never map half-written arrays
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix=os.path.basename(dirname) + '.',
+        suffix='.tmp', dir=cache_dir)
+    try:
+        ColumnarDataLoader.write(loader_class(filename), temporary)
+        with open(os.path.join(temporary, 'source.json'), 'w') as file:
+            json.dump(source, file)
+
+        # a concurrent conversion may have finished first, otherwise an
+        # outdated cache is moved aside, loaders already mapped its arrays
+        if get_cache_source(dirname) != source:
+            if os.path.isdir(dirname):
+                os.replace(dirname, os.path.join(temporary, 'outdated'))
+            os.replace(temporary, dirname)
+
+    except OSError:
+        if get_cache_source(dirname) != source:
+            raise
+
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+        shutil.rmtree(os.path.join(dirname, 'outdated'), ignore_errors=True)
+
+    return ColumnarDataLoader(dirname)
+
+
+
+def get_cache_source(dirname):
+    """Get the source info of a converted cache, or None if there isn't one."""
+
+    try:
+        with open(os.path.join(dirname, 'source.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+
+class LiveDataLoader(abc.ABC):
+    """Base for loading data that arrives while a simulation is running.
+
+    A reader thread parses incoming data into timesteps and puts them in a
+    bounded buffer. If the analyzer falls behind, the buffer fills up and
+    the reader stops reading, which in turn holds back the data source.
+    Subclasses provide the timesteps() generator of the reader thread.
+    """
+
+    STOP_TIMEOUT = 1    # seconds to wait for an earlier reader to stop
+
+    # names of entry columns in SUMO's xml2csv output of FCD files
+    COLUMN_NAMES = {'timestep_time': 'time', 'vehicle_id': 'id',
+        'vehicle_type': 'type', 'vehicle_lane': 'lane', 'vehicle_pos': 'pos',
+        'vehicle_speed': 'speed'}
+
+    def __init__(self, buffer_size=64):
+
+        # buffered timesteps, the reader thread and a flag to stop it early
+        self.buffer = queue.Queue(buffer_size)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lanes = {}
+
+
+    def read(self):
+        """Read timesteps from the buffer as soon as the reader adds them.
+
+        Every read starts reading the source again, with a new reader
+        thread, once that of an earlier read has stopped.
+        """
+
+        # stop an earlier reader, it notices at its next timestep or poll
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join(self.STOP_TIMEOUT)
+            if self.thread.is_alive():
+                raise RuntimeError("The reader thread of an earlier read "
+                    "is still waiting for its source.")
+
+        self.stopped.clear()
+        self.buffer = queue.Queue(self.buffer.maxsize)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        try:
+            while True:
+                timestep = self.buffer.get()
+
+                # end of data, or reading failed
+                if timestep is None:
+                    break
+                if isinstance(timestep, Exception):
+                    raise timestep
+
+                yield timestep
+
+        # stop the reader thread if the analyzer stopped before the end
+        finally:
+            self.stopped.set()
+
+
+    def run(self):
+        """Put the timesteps of the source in the buffer, in a thread."""
+
+        try:
+            for timestep in self.timesteps():
+                if not self.put(timestep):
+                    return
+
+        # pass errors to the analyzer thread, they are raised there
+        except Exception as e:
+            self.put(e)
+            return
+
+        self.put(None)
+
+
+    def put(self, item):
+        """Wait for space in the buffer, unless reading was stopped."""
+
+        while not self.stopped.is_set():
             try:
-                # if reached end of timestep, init new vehicle list
-                if event == "end" and elem.tag == 'timestep':
-                    entries = []
-                    time = float(elem.attrib['time'])
+                self.buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+
+    @abc.abstractmethod
+    def timesteps(self):
+        """Parse the source into timesteps, to be provided by subclasses."""
+
+
+    def parse_lines(self, lines):
+        """Parse delimited lines with a header row into timesteps.
+
+        Each row is a single vehicle entry, a row without vehicle id only
+        marks a timestep without vehicles. A timestep is complete once a
+        row of a later timestep arrives, or the lines end.
+        """
+
+        lanes = self.lanes
+
+        # find delimiter and column positions from the header
+        header = next(lines).strip()
+        delimiter = ';' if ';' in header else ','
+        names = [self.COLUMN_NAMES.get(name, name)
+            for name in header.split(delimiter)]
+        columns = [names.index(name)
+            for name in ('time', 'id', 'type', 'lane', 'pos', 'speed')]
+
+        current = None
+        entries = []
+        for line in lines:
+            if not line.strip():
+                continue
+
+            row = line.rstrip('\r\n').split(delimiter)
+            time, _id, _type, lane, pos, speed = (row[i] for i in columns)
+            time = float(time)
+
+            # a new timestep started, the previous one is complete
+            if time != current:
+                if current is not None:
+                    yield current, entries
+                current = time
+                entries = []
+
+            if _id:
+
+                # split lane to edge and lane ids only once per lane
+                if lane not in lanes:
+                    split = lane.rpartition('_')
+                    lanes[lane] = (sys.intern(split[0]), split[2])
+                edge_id, lane_id = lanes[lane]
+
+                entries.append(Entry.from_values(sys.intern(_id),
+                    sys.intern(_type), time, edge_id, lane_id, float(pos),
+                    float(speed)))
+
+        if current is not None:
+            yield current, entries
+
+
+
+class SocketDataLoader(LiveDataLoader):
+    """Initialize live data loading from a socket feed of entry lines.
+
+    The address is either a (host, port) tuple for TCP or the path of a
+    Unix socket. The feed is read as delimited lines, see parse_lines.
+    """
+    def __init__(self, address, buffer_size=64):
+        super().__init__(buffer_size)
+
+        self.address = address
+
+
+    def timesteps(self):
+        """Connect to the feed and parse its lines until it closes."""
+
+        family = (socket.AF_UNIX if isinstance(self.address, str)
+            else socket.AF_INET)
+
+        with socket.socket(family, socket.SOCK_STREAM) as connection:
+            connection.connect(self.address)
+
+            with connection.makefile('r') as lines:
+                yield from self.parse_lines(lines)
+
+
+
+class TailDataLoader(LiveDataLoader):
+    """Initialize live data loading from a file that is still being written.
 
-                    # iterate through vehicle entries and store them
-                    for entry in elem:
-                        entries.append(Entry(entry.attrib, time))
+    Files ending in .xml are read as SUMO FCD output, any other file as
+    delimited lines (see parse_lines). Reading stops at the end of the xml
+    document, or once the file hasn't grown for the idle timeout if one is
+    given.
+    """
+    def __init__(self, filename, buffer_size=64, poll_interval=0.1,
+        idle_timeout=None):
+        super().__init__(buffer_size)
 
-                    # cleanup already read xml and yield time and entries
-                    self.root.clear()
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+
+
+    def timesteps(self):
+        """Follow the file and parse it as it grows."""
+
+        with open(self.filename) as file:
+            chunks = self.follow(file)
+
+            if self.filename.endswith('.xml'):
+                yield from self.parse_xml(chunks)
+            else:
+                yield from self.parse_lines(self.split_lines(chunks))
+
+
+    def follow(self, file):
+        """Read newly written data, waiting for the file to grow."""
+
+        idle = 0
+        while not self.stopped.is_set():
+            chunk = file.read(65536)
+
+            if chunk:
+                idle = 0
+                yield chunk
+
+            # nothing new, wait unless idle for too long
+            else:
+                if self.idle_timeout is not None and idle >= self.idle_timeout:
+                    return
+                self.stopped.wait(self.poll_interval)
+                idle += self.poll_interval
+
+
+    def split_lines(self, chunks):
+        """Split data chunks in complete lines."""
+
+        remainder = ''
+        for chunk in chunks:
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            yield from lines
+
+        if remainder:
+            yield remainder
+
+
+    def parse_xml(self, chunks):
+        """Parse xml data chunks into timesteps, until the document ends."""
+
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        root = None
+
+        for chunk in chunks:
+            parser.feed(chunk)
+
+            for event, elem in parser.read_events():
+
+                # remember root, its end is also the end of the data
+                if root is None:
+                    root = elem
+                elif event == 'end' and elem is root:
+                    return
+
+                # if reached end of timestep, yield its entries
+                elif event == 'end' and elem.tag == 'timestep':
+                    time = float(elem.attrib['time'])
+                    entries = [Entry(entry.attrib, time) for entry in elem]
+
+                    # cleanup already read xml
+                    root.remove(elem)
                     yield time, entries
 
-            # Read error checking
-            except ET.ParseError as e:
-                print("Problem while reading xml file.\n", e)
 
-        # end of file, close it
-        self.file.close()
 
+class ProbeDataLoader():
+    """Initialize loading of raw GPS probe points, matched to network edges.
+
+    Probe points are read from a delimited file with a header row, with
+    the time, vehicle id, speed and either x/y network coordinates or
+    lon/lat columns (and optionally the vehicle type and heading), sorted
+    by time. Rows with a different number of fields than the header are
+    left out. Points are matched in bulk chunks to the nearest edge within
+    the maximum distance whose direction agrees with the heading, points
+    farther from every edge are left out. Every
+    vehicle should report at least once per calculation cycle, or it is
+    counted as having left the network in between.
+    """
+
+    # accepted column names, including those of SUMO's xml2csv FCD output
+    COLUMN_NAMES = {'timestep_time': 'time', 'vehicle_id': 'id',
+        'vehicle_type': 'type', 'vehicle_speed': 'speed', 'vehicle_x': 'x',
+        'vehicle_y': 'y', 'vehicle_angle': 'angle', 'lng': 'lon',
+        'longitude': 'lon', 'latitude': 'lat', 'heading': 'angle',
+        'bearing': 'angle'}
+
+    def __init__(self, filename, model, max_distance=20, chunk_size=100000):
+
+        self.filename = filename
+        self.model = model
+        self.max_distance = max_distance    # in meters, from the edge shape
+        self.chunk_size = chunk_size        # points matched at once
+        self.unmatched = 0                  # points left out so far
+        self.malformed = 0                  # rows left out so far
+
+
+    def read(self):
+        """Read, match and group probe points into timesteps."""
+
+        index = self.model.spatial_index
+        edge_ids = [sys.intern(str(edge_id)) for edge_id in index.edge_ids]
+
+        with open(self.filename, newline='') as file:
+
+            # find delimiter and column positions from the header
+            header = file.readline().strip()
+            delimiter = ';' if ';' in header else ','
+            names = [self.COLUMN_NAMES.get(name, name)
+                for name in next(csv.reader([header], delimiter=delimiter))]
+            geographic = 'x' not in names
+            columns = [names.index(name) for name in ('time', 'id', 'speed')
+                + (('lon', 'lat') if geographic else ('x', 'y'))]
+            type_column = names.index('type') if 'type' in names else None
+            angle_column = names.index('angle') if 'angle' in names else None
+
+            reader = csv.reader(file, delimiter=delimiter)
+            current = None
+            entries = []
+            while True:
+                chunk = list(itertools.islice(reader, self.chunk_size))
+                if not chunk:
+                    break
+
+                # leave out rows that don't match the header, and blank ones
+                rows = [row for row in chunk if len(row) == len(names)]
+                self.malformed += sum(1 for row in chunk
+                    if row and len(row) != len(names))
+                if not rows:
+                    continue
+
+                # convert and match the whole chunk at once
+                values = list(zip(*rows))
+                time, speed, x, y = (np.array(values[i], dtype=float)
+                    for i in (columns[0], columns[2], columns[3], columns[4]))
+                if geographic:
+                    x, y = self.model.to_network(x, y)
+                headings = (np.array([angle or 'nan'
+                    for angle in values[angle_column]], dtype=float)
+                    if angle_column is not None else None)
+                edges, _, pos = index.match(np.column_stack((x, y)),
+                    self.max_distance, headings)
+
+                if (current is not None and time[0] < current) \
+                    or (np.diff(time) < 0).any():
+                    raise ValueError("Probe data is not sorted by time.")
+
+                ids = values[columns[1]]
+                types = (values[type_column] if type_column is not None
+                    else ("DEFAULT_VEHTYPE",) * len(rows))
+                self.unmatched += int((edges < 0).sum())
+
+                for _id, _type, t, e, p, v in zip(ids, types, time.tolist(),
+                    edges.tolist(), pos.tolist(), speed.tolist()):
+
+                    # a new timestep started, the previous one is complete
+                    if t != current:
+                        if current is not None:
+                            yield current, entries
+                        current = t
+                        entries = []
+
+                    # lanes are not known, only the matched edge
+                    if e >= 0:
+                        entries.append(Entry.from_values(sys.intern(_id),
+                            sys.intern(_type), t, edge_ids[e], '', p, v))
+
+            if current is not None:
+                yield current, entries
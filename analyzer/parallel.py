@@ -0,0 +1,185 @@
+"""Parallel road network performance metrics calculation
+
+This file contains an analyzer that splits a simulation into time windows
+and analyzes them in a pool of worker processes. Each window starts one
+calculation cycle early, which is enough to rebuild the vehicle registry (it
+only holds the vehicles of the last cycle, in the order they were seen) and
+the vehicle counters of all systems, and reports raw system counters. The
+main process then stitches the windows back into one ordered stream of
+metrics. These are identical to a serial run as long as the pce values are
+sums of powers of two, other values can differ in the last bit.
+
+Classes:
+    ShardAnalyzer
+    ParallelMOEAnalyzer
+
+Functions:
+    init_shard_worker
+    analyze_shard
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from analyzer.loaders import ColumnarDataLoader
+from analyzer.vectorized import VectorizedMOEAnalyzer, compute_moes
+
+
+_shard_worker = {}
+
+
+def init_shard_worker(model, dirname, pce, calculation_rate, cycles):
+    """Store the model and analysis settings in a shard worker process."""
+
+    _shard_worker['model'] = model
+    _shard_worker['dirname'] = dirname
+    _shard_worker['pce'] = pce
+    _shard_worker['calc_rate'] = calculation_rate
+    _shard_worker['cycles'] = cycles
+
+
+def analyze_shard(shard):
+    """Get the raw counters of every cycle in a range of cycles.
+
+    Cycles are given as the start and stop timestep indices of the window
+    each one reads, with the cycle time before it. The range starts one
+    cycle early to rebuild the state of vehicles and systems.
+    """
+
+    first, end = shard
+    cycles = _shard_worker['cycles']
+    warmup = min(first, 1)
+
+    loader = ColumnarDataLoader(_shard_worker['dirname'],
+        cycles[first - warmup][0], cycles[end - 1][1])
+    analyzer = ShardAnalyzer(_shard_worker['model'], loader,
+        _shard_worker['pce'], _shard_worker['calc_rate'])
+    analyzer.last_cycle = cycles[first - warmup][2]
+
+    results = []
+    for cycle, (counters, time) in enumerate(analyzer.get_next_metrics()):
+
+        # after warm-up, only count vehicles visiting during this range
+        if cycle < warmup:
+            analyzer.v_visited[:] = 0
+        else:
+            results.append((time, counters))
+
+    return results, analyzer.v_visited
+
+
+class ShardAnalyzer(VectorizedMOEAnalyzer):
+    """Array analyzer that returns raw system counters instead of metrics."""
+
+    def compute_metrics(self, time_diff):
+        """Get the counters of all systems for this cycle, then reset them."""
+
+        # if it's not the very fist timestep
+        if self.last_cycle != 0:
+
+            counters = (time_diff, self.v_current.copy(),
+                self.v_visited.copy(), self.total_ideal_time.copy())
+
+            # reset counters
+            self.total_dist[:] = 0
+            self.total_ideal_time[:] = 0
+
+            return counters
+
+        # if it's the first timestamp, there are no metrics, but the cycle
+        # still ended and is stitched in, None would tell step() it didn't
+        else:
+            return ()
+
+
+
+class ParallelMOEAnalyzer(VectorizedMOEAnalyzer):
+    """Metric calculation over time windows of a simulation in parallel.
+
+    The loader has to be a ColumnarDataLoader, so that workers can map the
+    same cached simulation and read only their own window of it. Visited
+    vehicle counts are offset by the totals of all previous windows, which
+    is exact as long as the pce values are sums of powers of two.
+    """
+    def __init__(self, model, loader, pce, calculation_rate = 1,
+        as_arrays = False, workers = None, shards = None):
+        super().__init__(model, loader, pce, calculation_rate, as_arrays)
+
+        # number of worker processes and of windows split among them
+        self.workers = workers or os.cpu_count()
+        self.shards = shards or self.workers * 4
+
+
+    def get_next_metrics(self):
+        """Analyze simulation windows in parallel, yield metrics in order."""
+
+        # analyze serially if there's nothing to split the work with
+        if self.workers == 1 or self.shards == 1:
+            yield from super().get_next_metrics()
+            return
+
+        cycles = self.get_cycles()
+        if not cycles:
+            return
+
+        count = min(self.shards, len(cycles))
+        bounds = [len(cycles) * i // count for i in range(count + 1)]
+
+        with ProcessPoolExecutor(self.workers, initializer=init_shard_worker,
+            initargs=(self.model, self.loader.dirname, self.pce,
+                self.calc_rate, cycles)) as executor:
+
+            # submit contiguous ranges of nearly equal size, collect in order
+            futures = [executor.submit(analyze_shard, shard)
+                for shard in zip(bounds, bounds[1:])]
+
+            try:
+                visited = np.zeros(self.incidence.size)
+                for future in futures:
+                    results, shard_visited = future.result()
+
+                    for time, counters in results:
+                        yield self.stitch_metrics(counters, visited), time
+
+                    visited += shard_visited
+
+            # don't wait for remaining ranges if iteration stopped early
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+    def get_cycles(self):
+        """Find the timestep window read by each cycle, like the serial loop.
+
+        Cycles are returned as start and stop timestep indices, with the
+        cycle time before them.
+        """
+
+        cycles = []
+        start = self.loader.start
+        last_cycle = self.last_cycle
+        for index, time in enumerate(self.loader.times.tolist(), start):
+            if time - last_cycle >= self.calc_rate:
+                cycles.append((start, index + 1, last_cycle))
+                start = index + 1
+                last_cycle = last_cycle + self.calc_rate
+
+        return cycles
+
+
+    def stitch_metrics(self, counters, visited):
+        """Compute a cycle's metrics, offsetting counts of earlier windows."""
+
+        # first timestep has no metrics
+        if not counters:
+            return {} if self.as_arrays else ({}, {}, {})
+
+        time_diff, v_current, v_visited, ideal_time = counters
+        metrics = compute_moes(time_diff, v_current, v_visited + visited,
+            ideal_time)
+
+        return metrics if self.as_arrays else self.key_metrics(metrics)
@@ -0,0 +1,217 @@
+"""Columnar analysis results
+
+This file contains a writer that stores the metrics of every cycle as one
+row of a (cycle x system) array per metric, through fixed size buffers that
+are appended to flat binary files, and a reader that maps those files back
+as arrays. Memory use stays the same however long the simulation is, and
+results can be sliced or serialized as whole arrays instead of as nested
+per-system dicts.
+
+Classes:
+    ColumnarResultWriter
+    ColumnarResults
+
+"""
+
+import os, json
+import numpy as np
+
+from analyzer.vectorized import METRICS
+
+
+KINDS = ("edges", "paths", "groups")
+
+
+class ColumnarResultWriter():
+    """Append per-cycle metrics of all systems to columnar files.
+
+    Systems are the columns, in the order of the given ids per kind (edges,
+    paths and groups), the same order as the arrays of the vectorized
+    analyzer. Rows are buffered and written every chunk of cycles.
+    """
+    def __init__(self, dirname, ids, chunk_cycles = 1024):
+
+        self.dirname = dirname
+        self.ids = [list(kind_ids) for kind_ids in ids]
+        self.size = sum(len(kind_ids) for kind_ids in self.ids)
+        self.chunk_cycles = chunk_cycles
+        self.cycles = 0
+
+        # preallocated row buffers and the number of rows filled
+        self.times = np.zeros(chunk_cycles)
+        self.buffers = {metric: np.zeros((chunk_cycles, self.size))
+            for metric in METRICS}
+        self.filled = 0
+
+        # column positions of system ids, for dict metrics
+        self.positions = []
+        offset = 0
+        for kind_ids in self.ids:
+            self.positions.append({_id: offset + i
+                for i, _id in enumerate(kind_ids)})
+            offset += len(kind_ids)
+
+        # start empty files, overwriting earlier results
+        os.makedirs(dirname, exist_ok=True)
+        for name in ("times",) + METRICS:
+            open(os.path.join(dirname, name + ".f8"), "wb").close()
+        self.write_meta(False)
+
+
+    @classmethod
+    def for_model(cls, dirname, model, chunk_cycles = 1024):
+        """Create a writer for the systems of a road network model."""
+
+        return cls(dirname, (list(model.edge_systems),
+            list(model.path_systems), list(model.custom_systems)),
+            chunk_cycles)
+
+
+    def append(self, time, metrics):
+        """Add the metrics of a cycle, as arrays or as analyzer dicts.
+
+        Cycles without metrics (the first one) are skipped.
+        """
+
+        if not metrics or not any(metrics):
+            return
+
+        row = self.filled
+        self.times[row] = time
+
+        # arrays over all systems are copied as a whole
+        if isinstance(metrics, dict):
+            for metric in METRICS:
+                self.buffers[metric][row] = metrics[metric]
+
+        # dicts of each kind of system are placed by id
+        else:
+            for positions, systems in zip(self.positions, metrics):
+                for _id, values in systems.items():
+                    column = positions[_id]
+                    for metric in METRICS:
+                        self.buffers[metric][row, column] = values[metric]
+
+        self.filled += 1
+        if self.filled == self.chunk_cycles:
+            self.flush()
+
+
+    def write(self, results):
+        """Append all cycles of an analyzer's results, pass them through."""
+
+        for metrics, time in results:
+            self.append(time, metrics)
+            yield metrics, time
+
+        self.close()
+
+
+    def flush(self):
+        """Append the buffered rows to the files."""
+
+        if self.filled == 0:
+            return
+
+        with open(os.path.join(self.dirname, "times.f8"), "ab") as file:
+            file.write(self.times[:self.filled].tobytes())
+        for metric, buffer in self.buffers.items():
+            with open(os.path.join(self.dirname, metric + ".f8"), "ab") as file:
+                file.write(buffer[:self.filled].tobytes())
+
+        self.cycles += self.filled
+        self.filled = 0
+
+
+    def write_meta(self, complete):
+        """Store the system ids and state of the results."""
+
+        with open(os.path.join(self.dirname, "meta.json"), "w") as file:
+            json.dump({"ids": dict(zip(KINDS, self.ids)),
+                "metrics": METRICS, "cycles": self.cycles,
+                "complete": complete}, file)
+
+
+    def close(self):
+        """Write the remaining rows and mark the results as complete."""
+
+        self.flush()
+        self.write_meta(True)
+
+
+
+class ColumnarResults():
+    """Read columnar results as memory-mapped (cycle x system) arrays.
+
+    Results can be read while they are still being written, up to the last
+    chunk written so far.
+    """
+    def __init__(self, dirname):
+
+        self.dirname = dirname
+        with open(os.path.join(dirname, "meta.json")) as file:
+            meta = json.load(file)
+
+        self.ids = [meta["ids"][kind] for kind in KINDS]
+        self.complete = meta["complete"]
+        self.size = sum(len(kind_ids) for kind_ids in self.ids)
+
+        bounds = np.cumsum([0] + [len(kind_ids) for kind_ids in self.ids])
+        self.kinds = {kind: slice(bounds[i], bounds[i+1])
+            for i, kind in enumerate(KINDS)}
+
+        # only whole rows written to every file so far
+        self.cycles = min(os.path.getsize(self.get_filename(name)) // 8
+            // (1 if name == "times" else max(self.size, 1))
+            for name in ("times",) + METRICS)
+        self.times = self.load("times")
+
+
+    def get_filename(self, name):
+        """Get the file of a column."""
+        return os.path.join(self.dirname, name + ".f8")
+
+
+    def load(self, name):
+        """Map a column file as an array of the complete cycles."""
+
+        if self.cycles == 0:
+            return np.zeros((0,) if name == "times" else (0, self.size))
+
+        shape = (self.cycles,) if name == "times" else (self.cycles,
+            self.size)
+        return np.memmap(self.get_filename(name), dtype='f8', mode='r',
+            shape=shape)
+
+
+    def get(self, metric, kind = None, start = None, end = None):
+        """Get a metric's (cycle x system) array, optionally a part of it.
+
+        Systems can be limited to a kind ("edges", "paths" or "groups") and
+        cycles to a time window.
+        """
+
+        first = 0 if start is None else np.searchsorted(self.times, start)
+        last = (self.cycles if end is None
+            else np.searchsorted(self.times, end, side='right'))
+        columns = slice(None) if kind is None else self.kinds[kind]
+
+        return self.load(metric)[first:last, columns]
+
+
+    def read(self, start = None, end = None):
+        """Yield cycles in the analyzer's nested dict format."""
+
+        first = 0 if start is None else np.searchsorted(self.times, start)
+        last = (self.cycles if end is None
+            else np.searchsorted(self.times, end, side='right'))
+        arrays = [self.load(metric) for metric in METRICS]
+
+        for row in range(first, last):
+            columns = [array[row].tolist() for array in arrays]
+            metrics = tuple({_id: dict(zip(METRICS, values))
+                    for _id, *values in zip(self.ids[i],
+                        *(column[self.kinds[kind]] for column in columns))}
+                for i, kind in enumerate(KINDS))
+
+            yield metrics, float(self.times[row])
@@ -0,0 +1,242 @@
+"""Asynchronous analysis service
+
+This file contains a service that runs MOE analysis jobs in a pool of
+worker processes, scheduled by an asyncio event loop in a background
+thread, so that many analyses can run at once without blocking the caller.
+Jobs store their metrics in the metric store, where their results can be
+queried while and after they run.
+
+Classes:
+    Job
+    AnalysisService
+
+Functions:
+    run_analysis
+
+"""
+
+import os
+import uuid
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from analyzer.vectorized import VectorizedMOEAnalyzer
+from analyzer.loaders import cache_simulation
+from analyzer.store import MetricStore
+from analyzer.stats import PipelineStats
+
+
+STATS_CYCLES = 100     # cycles between stats reports of a job
+MAX_JOBS = 256         # jobs kept, the oldest finished ones are forgotten
+
+
+def run_analysis(model, simulation, cache_dir, key, pce, calculation_rate,
+    state):
+    """Analyze a simulation and store its metrics, in a worker process.
+
+    Progress is reported through the shared state dict, which is also
+    checked for cancellation before starting and after every cycle, and
+    pipeline stats every few cycles. Returns False if the job was cancelled
+    before it finished.
+    """
+
+    # jobs cancelled while waiting for a worker don't start at all
+    if state['cancelled']:
+        return False
+    state['started'] = True
+
+    stats = PipelineStats()
+    loader = cache_simulation(simulation, cache_dir)
+    analyzer = VectorizedMOEAnalyzer(model, loader, pce, calculation_rate,
+        stats=stats)
+    store = MetricStore(os.path.join(cache_dir, "metrics.db"))
+
+    # progress is measured as the fraction of simulation time analyzed
+    first, last = (loader.times[0], loader.times[-1]) if len(loader.times) \
+        else (0, 0)
+
+    try:
+        for _, time in store.record(*key, analyzer.get_next_metrics()):
+            state['progress'] = ((time - first) / (last - first)
+                if last > first else 1)
+
+            if stats.cycles % STATS_CYCLES == 0:
+                state['stats'] = stats.to_dict()
+
+            if state['cancelled']:
+                return False
+
+    finally:
+        state['stats'] = stats.to_dict()
+        store.close()
+
+    state['progress'] = 1
+    return True
+
+
+
+class Job():
+    """A single analysis job and its current state."""
+    def __init__(self, session, key, state):
+
+        self.id = uuid.uuid4().hex
+        self.session = session
+        self.key = key              # metric store key of the results
+        self.state = state          # progress and cancellation, shared
+        self._status = "queued"
+        self.error = None
+
+
+    @property
+    def status(self):
+        """Get the job status, queued until a worker actually starts it."""
+
+        if self._status == "queued" and self.state.get('started'):
+            return "running"
+        return self._status
+
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+
+
+    def finished(self):
+        """Check if the job is done, cancelled or failed."""
+        return self._status not in ("queued", "running")
+
+
+    def progress(self):
+        """Get the fraction of the job completed."""
+        return self.state['progress']
+
+
+    def stats(self):
+        """Get the last reported pipeline stats of the job."""
+        return self.state.get('stats', {})
+
+
+    def to_dict(self):
+        """Get the job state in a serializable format."""
+
+        return {"id": self.id, "status": self.status,
+            "progress": self.progress(), "error": self.error}
+
+
+    def __repr__(self):
+        return ('{}({}|{})'.format(self.__class__.__name__, self.id,
+            self.status))
+
+
+
+class AnalysisService():
+    """Concurrent analysis jobs of many sessions in a process pool.
+
+    The worker pool and event loop are only started with the first job.
+    """
+    def __init__(self, workers=None):
+
+        self.workers = workers
+        self.jobs = {}
+        self.locks = {}     # per simulation being converted, and its users
+        self.loop = None
+
+
+    def start(self):
+        """Start the worker pool and the event loop thread."""
+
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.manager = multiprocessing.Manager()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+
+    def submit(self, session, model, simulation, cache_dir, key, pce,
+        calculation_rate):
+        """Schedule the analysis of a simulation, return its job."""
+
+        if self.loop is None:
+            self.start()
+
+        job = Job(session, key, self.manager.dict(progress=0,
+            cancelled=False))
+        self.jobs[job.id] = job
+
+        # forget the oldest finished jobs beyond the limit
+        finished = [job_id for job_id, job in list(self.jobs.items())
+            if job.finished()]
+        for job_id in finished[:max(0, len(self.jobs) - MAX_JOBS)]:
+            self.jobs.pop(job_id, None)
+
+        asyncio.run_coroutine_threadsafe(self.run(job, model, simulation,
+            cache_dir, key, pce, calculation_rate), self.loop)
+
+        return job
+
+
+    async def run(self, job, model, simulation, cache_dir, key, pce,
+        calculation_rate):
+        """Prepare the simulation and run a job in the worker pool."""
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            # convert each simulation to a columnar cache only once, even if
+            # many jobs start with it at the same time
+            await self.convert(simulation, cache_dir)
+
+            if job.state['cancelled']:
+                job.status = "cancelled"
+                return
+
+            # reported as running by the worker once it starts
+            finished = await loop.run_in_executor(self.pool, run_analysis,
+                model, simulation, cache_dir, key, pce, calculation_rate,
+                job.state)
+            job.status = "done" if finished else "cancelled"
+
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+
+
+    async def convert(self, simulation, cache_dir):
+        """Convert a simulation to a columnar cache, one job at a time.
+
+        The lock of a simulation is only kept while jobs are using it.
+        """
+
+        lock, users = self.locks.get(simulation, (asyncio.Lock(), 0))
+        self.locks[simulation] = (lock, users + 1)
+
+        try:
+            async with lock:
+                await asyncio.get_running_loop().run_in_executor(None,
+                    cache_simulation, simulation, cache_dir)
+
+        finally:
+            lock, users = self.locks[simulation]
+            if users > 1:
+                self.locks[simulation] = (lock, users - 1)
+            else:
+                del self.locks[simulation]
+
+
+    def get(self, session, job_id):
+        """Get a job of a session, or None if there isn't one."""
+
+        job = self.jobs.get(job_id)
+        return job if job is not None and job.session == session else None
+
+
+    def list(self, session):
+        """Get all jobs of a session."""
+        return [job for job in list(self.jobs.values())
+            if job.session == session]
+
+
+    def cancel(self, job):
+        """Stop a job after its current cycle, or before it starts."""
+        job.state['cancelled'] = True
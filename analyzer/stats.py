@@ -0,0 +1,123 @@
+"""Analysis pipeline instrumentation
+
+This file contains a class that collects low-overhead timers and counters
+of the stages of an analysis run (loading, reading entries, updating
+counters, computing metrics and cleaning up vehicles), so the time of a run
+can be broken down without attaching an external profiler.
+
+Classes:
+    PipelineStats
+
+"""
+
+import time
+from bisect import bisect_right
+
+
+class PipelineStats():
+    """Per-stage timers, throughput counters and cycle latency histogram.
+
+    Stage times are measured as laps: each lap adds the time since the
+    previous one to a stage, so instrumented code only reads the clock once
+    at every stage boundary. A callback, if given, is called with a record
+    of every cycle.
+    """
+
+    STAGES = ("load", "read", "update", "compute", "cleanup")
+
+    # upper bounds of cycle latency histogram bins, in seconds
+    BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+        0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self, callback = None):
+
+        self.callback = callback
+        self.reset()
+
+
+    def reset(self):
+        """Clear all timers and counters."""
+
+        self.times = dict.fromkeys(self.STAGES, 0.0)
+        self.timesteps = 0
+        self.entries = 0
+        self.cycles = 0
+        self.updates = 0        # vehicle updates of system counters
+        self.vehicles = 0       # vehicles tracked at the end of last cycle
+        self.peak_vehicles = 0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.max_latency = 0
+
+        self.started = time.time()
+        self.last = time.perf_counter()     # time of the last lap
+        self.latency = 0                    # time spent on current cycle
+
+
+    def lap(self, stage):
+        """Add the time since the previous lap to a stage."""
+
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+
+        self.times[stage] += elapsed
+        self.latency += elapsed
+
+
+    def timed(self, timesteps):
+        """Pass timesteps through, timing how long loading each one takes."""
+
+        self.last = time.perf_counter()
+        for timestep in timesteps:
+            self.lap("load")
+            self.timesteps += 1
+            self.entries += len(timestep[1])
+
+            yield timestep
+
+            # time spent by the consumer is timed by its own laps
+            self.last = time.perf_counter()
+
+
+    def end_cycle(self, time, vehicles, updates):
+        """Record the counters and latency of a completed cycle."""
+
+        self.cycles += 1
+        self.updates += updates
+        self.vehicles = vehicles
+        self.peak_vehicles = max(self.peak_vehicles, vehicles)
+
+        self.histogram[bisect_right(self.BUCKETS, self.latency)] += 1
+        self.max_latency = max(self.max_latency, self.latency)
+
+        if self.callback is not None:
+            self.callback({"time": time, "latency": self.latency,
+                "vehicles": vehicles, "updates": updates})
+
+        self.latency = 0
+
+
+    def to_dict(self):
+        """Get current timers, counters and rates in a serializable format."""
+
+        busy = sum(self.times.values())
+        elapsed = time.time() - self.started
+
+        return {
+            "elapsed": elapsed,
+            "times": dict(self.times),
+            "shares": {stage: stage_time / busy if busy else 0
+                for stage, stage_time in self.times.items()},
+            "timesteps": self.timesteps,
+            "entries": self.entries,
+            "cycles": self.cycles,
+            "updates": self.updates,
+            "vehicles": self.vehicles,
+            "peak_vehicles": self.peak_vehicles,
+            "entries_per_second": self.entries / busy if busy else 0,
+            "cycles_per_second": self.cycles / busy if busy else 0,
+            "latency": {
+                "mean": busy / self.cycles if self.cycles else 0,
+                "max": self.max_latency,
+                "buckets": list(self.BUCKETS),
+                "histogram": list(self.histogram)}}
@@ -0,0 +1,529 @@
+"""Historical metrics store
+
+This file contains a class that persists the per-cycle metrics of analysis
+runs in a local SQLite database, so that results can be revisited or
+queried for a time window or a few systems without recalculating them.
+
+Classes:
+    MetricStore
+
+"""
+
+import json
+import time
+import sqlite3
+
+from analyzer.vectorized import METRICS
+
+
+STATS = ("min", "mean", "max")
+
+class MetricStore():
+    """Persistent per-cycle metrics of analysis runs in an SQLite database.
+
+    Runs are keyed by network, simulation and a dict of configuration
+    values; metrics of each run by system kind, system id and cycle time.
+    Completed runs also get rollups of the minimum, mean and maximum of
+    each metric over fixed periods, for charts of long time ranges.
+    A run is only recorded by one writer at a time, identical runs started
+    meanwhile just pass their metrics through.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            network TEXT NOT NULL,
+            simulation TEXT NOT NULL,
+            config TEXT NOT NULL,
+            complete INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL,
+            UNIQUE (network, simulation, config));
+        CREATE TABLE IF NOT EXISTS cycles (
+            run INTEGER NOT NULL,
+            time REAL NOT NULL,
+            PRIMARY KEY (run, time)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS metrics (
+            run INTEGER NOT NULL,
+            kind INTEGER NOT NULL,
+            system TEXT NOT NULL,
+            time REAL NOT NULL,
+            pit REAL, thr REAL, td REAL, dpt REAL, tti REAL,
+            PRIMARY KEY (run, kind, system, time)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS metrics_time ON metrics (run, time);
+        CREATE TABLE IF NOT EXISTS rollups (
+            run INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            kind INTEGER NOT NULL,
+            system TEXT NOT NULL,
+            time REAL NOT NULL,
+            {},
+            PRIMARY KEY (run, resolution, time, kind, system)) WITHOUT ROWID;
+    """.format(", ".join("{}_{} REAL".format(metric, stat)
+        for metric in METRICS for stat in STATS))
+
+    VERSION = 2                     # schema version, older tables are dropped
+    RESOLUTIONS = (10, 60, 300)     # rollup periods in seconds
+    COMMIT_CYCLES = 100             # cycles written in one transaction
+    STALE_TIMEOUT = 300             # seconds until an unfinished run is replaced
+
+    def __init__(self, filename):
+
+        # requests may stream results from a different thread, and runs can
+        # be written by other processes while this one reads or waits
+        self.connection = sqlite3.connect(filename, timeout=60,
+            check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        # the store is a cache, so tables of an older schema are just dropped
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.VERSION:
+            self.connection.executescript("DROP TABLE IF EXISTS runs; "
+                "DROP TABLE IF EXISTS cycles; DROP TABLE IF EXISTS metrics; "
+                "DROP TABLE IF EXISTS rollups;")
+        self.connection.executescript(self.SCHEMA)
+        self.connection.execute("PRAGMA user_version={}".format(self.VERSION))
+
+
+    def get_run(self, network, simulation, config):
+        """Get the id of a completely stored run, or None if there isn't one."""
+
+        row = self.connection.execute("SELECT id FROM runs WHERE network=? "
+            "AND simulation=? AND config=? AND complete=1",
+            (network, simulation, json.dumps(config, sort_keys=True)))
+        row = row.fetchone()
+
+        return None if row is None else row[0]
+
+
+    def create_run(self, network, simulation, config):
+        """Start a new run, replacing earlier unfinished ones with the same key.
+
+        Returns None if the run is already stored, or still being recorded
+        by another writer, which kept it updated within the stale timeout.
+        """
+
+        config = json.dumps(config, sort_keys=True)
+        now = time.time()
+
+        with self.connection:
+            self.connection.execute("DELETE FROM runs WHERE network=? "
+                "AND simulation=? AND config=? AND complete=0 AND updated<?",
+                (network, simulation, config, now - self.STALE_TIMEOUT))
+            self.connection.execute("DELETE FROM cycles WHERE run NOT IN "
+                "(SELECT id FROM runs)")
+            self.connection.execute("DELETE FROM metrics WHERE run NOT IN "
+                "(SELECT id FROM runs)")
+            self.connection.execute("DELETE FROM rollups WHERE run NOT IN "
+                "(SELECT id FROM runs)")
+
+            cursor = self.connection.execute("INSERT OR IGNORE INTO runs "
+                "(network, simulation, config, updated) VALUES (?, ?, ?, ?)",
+                (network, simulation, config, now))
+
+        return cursor.lastrowid if cursor.rowcount else None
+
+
+    @staticmethod
+    def get_rows(run, time, metrics):
+        """Get the metrics rows of all systems for a single cycle."""
+
+        return ((run, kind, _id, time, *(values[metric] for metric in METRICS))
+            for kind, systems in enumerate(metrics)
+            for _id, values in systems.items())
+
+
+    def write(self, run, rows):
+        """Write buffered cycles, metrics and rollups rows of a run at once.
+
+        The buffers are emptied either way. Returns the run, or None if it
+        was replaced meanwhile, and nothing was written.
+        """
+
+        cycles, metrics, rollups = rows
+
+        if run is not None:
+            with self.connection:
+                cursor = self.connection.execute("UPDATE runs SET updated=? "
+                    "WHERE id=? AND complete=0", (time.time(), run))
+                if cursor.rowcount:
+                    self.connection.executemany("INSERT INTO cycles VALUES "
+                        "(?, ?)", cycles)
+                    self.connection.executemany("INSERT INTO metrics VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?)", metrics)
+                    self.connection.executemany("INSERT INTO rollups VALUES "
+                        "({})".format(",".join("?" * (5 + 3 * len(METRICS)))),
+                        rollups)
+                else:
+                    run = None
+
+        for buffer in rows:
+            buffer.clear()
+
+        return run
+
+
+    def finish(self, run, systems = None):
+        """Compute the rollups of a run and mark it as completely stored.
+
+        With a list of (kind, id) systems, only their rollups are computed.
+        """
+
+        # aggregate cycles in periods, labeled by the time they start at
+        columns = ", ".join("{0}({1})".format(function, metric)
+            for metric in METRICS for function in ("MIN", "AVG", "MAX"))
+        condition, arguments = self.get_systems_condition(systems)
+
+        with self.connection:
+            cursor = self.connection.execute("UPDATE runs SET complete=1 "
+                "WHERE id=? AND complete=0", (run,))
+            if not cursor.rowcount:
+                return
+
+            for resolution in self.RESOLUTIONS:
+                self.connection.execute("INSERT INTO rollups SELECT run, ?, "
+                    "kind, system, CAST(time / ? AS INTEGER) * ? AS period, "
+                    "{} FROM metrics WHERE run=?{} GROUP BY kind, system, "
+                    "period".format(columns, condition),
+                    [resolution, resolution, resolution, run] + arguments)
+
+
+    def record(self, network, simulation, config, results, resolution = None):
+        """Store metrics while passing them through, as a generator.
+
+        Rollups are aggregated while recording. With a rollup resolution,
+        each of its periods is passed through once it's complete, in the
+        query format, instead of every cycle. The run only counts as stored
+        once the results are exhausted, runs interrupted before that are
+        replaced the next time. If the run is being recorded by another
+        writer, the results are only passed through.
+        """
+
+        run = self.create_run(network, simulation, config)
+
+        # statistics of the current period of every resolution, each one
+        # merged into the next coarser resolution once complete
+        periods = [None] * len(self.RESOLUTIONS)
+
+        # cycles, metrics and rollups rows are written in short transactions
+        # in between, the lock isn't held while results are passed through
+        rows = ([], [], [])
+
+        for cycle, (metrics, time) in enumerate(results, 1):
+            rows[0].append((run, time))
+            rows[1].extend(self.get_rows(run, time, metrics))
+
+            for rollup in self.close_periods(run, periods, time, resolution,
+                rows[2]):
+                yield rollup
+
+            if periods[0] is None:
+                periods[0] = (self.get_period(time, self.RESOLUTIONS[0]), {})
+            self.aggregate(periods[0][1], metrics)
+
+            if cycle % self.COMMIT_CYCLES == 0:
+                run = self.write(run, rows)
+
+            if resolution is None:
+                yield metrics, time
+
+        for rollup in self.close_periods(run, periods, None, resolution,
+            rows[2]):
+            yield rollup
+
+        run = self.write(run, rows)
+        if run is not None:
+            self.finish(run, ())
+
+
+    @staticmethod
+    def get_period(time, resolution):
+        """Get the start of the rollup period of a time, as in finish."""
+        return int(time / resolution) * resolution
+
+
+    @staticmethod
+    def aggregate(statistics, metrics):
+        """Add the metrics of a cycle to the statistics of a period.
+
+        Statistics are the minimum, sum, count and maximum of every metric,
+        by (kind, id) system.
+        """
+
+        for kind, systems in enumerate(metrics):
+            for _id, values in systems.items():
+                system = statistics.get((kind, _id))
+                if system is None:
+                    system = statistics[(kind, _id)] = {metric:
+                        [None, 0, 0, None] for metric in METRICS}
+
+                for metric in METRICS:
+                    value = values[metric]
+                    if value is not None:
+                        stats = system[metric]
+                        if stats[2] == 0:
+                            stats[:] = [value, value, 1, value]
+                        else:
+                            stats[0] = min(stats[0], value)
+                            stats[1] += value
+                            stats[2] += 1
+                            stats[3] = max(stats[3], value)
+
+
+    @staticmethod
+    def merge(statistics, other):
+        """Add the statistics of a finer period to those of a coarser one."""
+
+        for system, metrics in other.items():
+            if system not in statistics:
+                statistics[system] = {metric: list(stats)
+                    for metric, stats in metrics.items()}
+                continue
+
+            for metric, stats in metrics.items():
+                if stats[2] == 0:
+                    continue
+                total = statistics[system][metric]
+                if total[2] == 0:
+                    total[:] = stats
+                else:
+                    total[0] = min(total[0], stats[0])
+                    total[1] += stats[1]
+                    total[2] += stats[2]
+                    total[3] = max(total[3], stats[3])
+
+
+    def close_periods(self, run, periods, time, resolution, rows):
+        """Close the periods a cycle time is past, finest ones first.
+
+        Periods of coarser resolutions start and end with those of finer
+        ones, so they're only closed once the finer ones are. Their rollups
+        rows are added to rows. Every closed period of the given resolution
+        is returned in the query format, all remaining periods are closed if
+        the time is None.
+        """
+
+        closed = []
+
+        for index, period_resolution in enumerate(self.RESOLUTIONS):
+            current = periods[index]
+            if current is None or (time is not None and current[0]
+                == self.get_period(time, period_resolution)):
+                break
+
+            period, statistics = current
+            periods[index] = None
+            rows.extend((run, period_resolution, kind, _id, period, *(value
+                for metric in METRICS for value in self.get_stats(
+                    metrics[metric])))
+                for (kind, _id), metrics in statistics.items())
+
+            # the coarser period continues, or starts with this one
+            if index + 1 < len(self.RESOLUTIONS):
+                if periods[index + 1] is None:
+                    periods[index + 1] = (self.get_period(period,
+                        self.RESOLUTIONS[index + 1]), {})
+                self.merge(periods[index + 1][1], statistics)
+
+            if period_resolution == resolution and statistics:
+                rollup = ({}, {}, {})
+                for (kind, _id), metrics in statistics.items():
+                    rollup[kind][_id] = {metric: dict(zip(STATS,
+                        self.get_stats(stats)))
+                        for metric, stats in metrics.items()}
+                closed.append((rollup, period))
+
+        return closed
+
+
+    @staticmethod
+    def get_stats(stats):
+        """Get the minimum, mean and maximum of aggregated statistics."""
+
+        minimum, total, count, maximum = stats
+        return (minimum, total / count, maximum) if count else (None,) * 3
+
+
+    def derive(self, run, network, simulation, config, removed = (),
+        results = ()):
+        """Store a run as a copy of another one with some systems changed.
+
+        Metrics of the removed (kind, id) systems are left out, and those of
+        results, the metrics of added systems over the same cycles, are
+        added, so a change of the model's paths or groups doesn't need a
+        whole new run. Only the rollups of added systems are computed.
+        Like record, the metrics of all systems are passed through as a
+        generator, and the run only counts as stored once they're exhausted.
+        """
+
+        new_run = self.create_run(network, simulation, config)
+        condition, arguments = self.get_systems_condition(removed, False)
+
+        # the copy is skipped if the run is being recorded by another writer
+        if new_run is not None:
+            with self.connection:
+                self.connection.execute("INSERT INTO cycles SELECT ?, time "
+                    "FROM cycles WHERE run=?", (new_run, run))
+                self.connection.execute("INSERT INTO metrics SELECT ?, kind, "
+                    "system, time, {} FROM metrics WHERE run=?{}".format(
+                        ",".join(METRICS), condition),
+                    [new_run, run] + arguments)
+                self.connection.execute("INSERT INTO rollups SELECT ?, "
+                    "resolution, kind, system, time, {} FROM rollups WHERE "
+                    "run=?{}".format(",".join("{}_{}".format(metric, stat)
+                        for metric in METRICS for stat in STATS), condition),
+                    [new_run, run] + arguments)
+
+        # merge each replayed cycle into the stored one as it's produced
+        removed = {(kind, str(_id)) for kind, _id in removed}
+        added = set()
+        rows = ([], [], [])
+        for cycle, ((metrics, time), (stored, _)) in enumerate(
+            zip(results, self.query(run)), 1):
+
+            rows[1].extend(self.get_rows(new_run, time, metrics))
+
+            for kind, systems in enumerate(stored):
+                for _id in [_id for _id in systems if (kind, _id) in removed]:
+                    del systems[_id]
+                for _id, values in metrics[kind].items():
+                    systems[str(_id)] = values
+                    added.add((kind, _id))
+
+            # written in short transactions, like in record
+            if cycle % self.COMMIT_CYCLES == 0:
+                new_run = self.write(new_run, rows)
+
+            yield stored, time
+
+        new_run = self.write(new_run, rows)
+        if new_run is not None:
+            self.finish(new_run, sorted(added))
+
+
+    @staticmethod
+    def get_systems_condition(systems, included = True):
+        """Get an SQL condition, and its arguments, on (kind, id) systems.
+
+        Rows of all systems are included if systems is None, and none if it
+        is empty, or the opposite if not included.
+        """
+
+        if systems is None:
+            return "", []
+
+        systems = [(kind, str(_id)) for kind, _id in systems]
+        if not systems:
+            return ("", []) if not included else (" AND 0", [])
+
+        return (" AND (kind, system) {}IN (VALUES {})".format(
+                "" if included else "NOT ",
+                ",".join(["(?, ?)"] * len(systems))),
+            [value for system in systems for value in system])
+
+
+    def query(self, run, start = None, end = None, systems = None,
+        resolution = None):
+        """Get stored metrics of a run per cycle, in the analyzer format.
+
+        Cycles can be limited to a time window and metrics to the systems
+        with the given ids. With a rollup resolution, each period is
+        returned instead, with the min, mean and max of every metric.
+        """
+
+        # time window condition, used for both cycles and metrics
+        window = "run=?"
+        arguments = [run]
+        if resolution is not None:
+            window += " AND resolution=?"
+            arguments.append(resolution)
+        if start is not None:
+            window += " AND time>=?"
+            arguments.append(start)
+        if end is not None:
+            window += " AND time<=?"
+            arguments.append(end)
+
+        condition = window
+        if systems is not None:
+            systems = list(systems)
+            condition += " AND system IN ({})".format(
+                ",".join("?" * len(systems)))
+
+        # periods are listed by the rollups themselves, cycles separately
+        if resolution is None:
+            table = "metrics"
+            columns = ",".join(METRICS)
+            times = self.connection.execute("SELECT time FROM cycles WHERE "
+                + window + " ORDER BY time", arguments)
+        else:
+            table = "rollups"
+            columns = ",".join("{}_{}".format(metric, stat)
+                for metric in METRICS for stat in STATS)
+            times = self.connection.execute("SELECT DISTINCT time FROM "
+                "rollups WHERE " + window + " ORDER BY time", arguments)
+
+        rows = self.connection.execute("SELECT time, kind, system, {} FROM "
+            "{} WHERE {} ORDER BY time".format(columns, table, condition),
+            arguments + (systems or []))
+
+        # group metric rows by cycle, cycles without any are still returned
+        row = next(rows, None)
+        for time, in times:
+            metrics = ({}, {}, {})
+
+            while row is not None and row[0] == time:
+                if resolution is None:
+                    values = dict(zip(METRICS, row[3:]))
+                else:
+                    values = {metric: dict(zip(STATS, row[3+3*i:6+3*i]))
+                        for i, metric in enumerate(METRICS)}
+
+                metrics[row[1]][row[2]] = values
+                row = next(rows, None)
+
+            yield metrics, time
+
+
+    def get_resolution(self, run, start = None, end = None, points = None):
+        """Find the finest resolution showing a time window in few points.
+
+        Returns None if the cycles themselves are few enough, or the
+        coarsest rollup resolution if none of them is.
+        """
+
+        window = "run=?"
+        arguments = [run]
+        if start is not None:
+            window += " AND time>=?"
+            arguments.append(start)
+        if end is not None:
+            window += " AND time<=?"
+            arguments.append(end)
+
+        count, first, last = self.connection.execute("SELECT COUNT(*), "
+            "MIN(time), MAX(time) FROM cycles WHERE " + window,
+            arguments).fetchone()
+
+        return self.choose_resolution(count, first, last, points)
+
+
+    @classmethod
+    def choose_resolution(cls, count, first, last, points = None):
+        """Find the finest resolution showing count cycles in few points.
+
+        The cycles are between the first and last time, see get_resolution.
+        """
+
+        if points is None or count <= points:
+            return None
+
+        for resolution in cls.RESOLUTIONS:
+            if (last - first) / resolution <= points:
+                return resolution
+
+        return cls.RESOLUTIONS[-1]
+
+
+    def close(self):
+        """Close the database connection."""
+        self.connection.close()
@@ -0,0 +1,66 @@
+"""Road network performance metrics parameter sweeps
+
+This file contains a class that runs several analyzer configurations, e.g.
+different pce tables and calculation rates, over the same simulation. The
+loader is only read once, and each timestep is passed on to every
+analyzer in turn.
+
+Classes:
+    ParameterSweep
+
+"""
+
+import copy
+
+from analyzer.vectorized import VectorizedMOEAnalyzer
+
+
+
+class ParameterSweep():
+    """Metric calculation for many configurations over one loader stream.
+
+    Configurations are given as a dict of pce tables and (optional)
+    calculation rates, keyed by any name that identifies them.
+    """
+    def __init__(self, model, loader, configs,
+        analyzer_class = VectorizedMOEAnalyzer):
+
+        self.model = model
+        self.loader = loader
+        self.analyzers = {}
+
+        for key, config in configs.items():
+
+            # array analyzers keep their own counters and can share a model,
+            # object analyzers keep them in the systems and need a copy
+            if issubclass(analyzer_class, VectorizedMOEAnalyzer):
+                analyzer_model = model
+            else:
+                analyzer_model = copy.deepcopy(model)
+
+            self.analyzers[key] = analyzer_class(analyzer_model, loader,
+                config['pce'], config.get('calculation_rate', 1))
+
+
+    def get_next_metrics(self):
+        """Read each timestep once, yield metrics of any configuration."""
+
+        # time loop
+        for time, entries in self.loader.read():
+
+            # pass the same entries to every configuration
+            for key, analyzer in self.analyzers.items():
+
+                metrics = analyzer.step(time, entries)
+                if metrics is not None:
+                    yield key, metrics, time
+
+
+    def run(self):
+        """Read the entire simulation, return metrics keyed by configuration."""
+
+        results = {key: [] for key in self.analyzers}
+        for key, metrics, time in self.get_next_metrics():
+            results[key].append((metrics, time))
+
+        return results
@@ -0,0 +1,95 @@
+"""Vehicle data loader throughput benchmark
+
+This script compares the throughput of the xml data loader with reading the
+columnar cache of the sample simulation outputs, after checking they produce
+identical entries. The cache is converted once before timing, and the time
+of that conversion, which parses the file with the xml loader, is shown as
+well.
+
+Usage:
+    python benchmarks/loader_throughput.py [repeats] [files...]
+
+"""
+
+import sys, os, glob, time, tempfile
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from analyzer.loaders import XmlDataLoader, cache_simulation
+from model.vehicle import Entry
+
+
+def get_loaders(filename, cache_dir):
+    """Get named loader factories for a file with a converted cache."""
+
+    return [
+        ("XmlDataLoader", lambda: XmlDataLoader(filename)),
+        ("ColumnarDataLoader", lambda: cache_simulation(filename, cache_dir)),
+    ]
+
+
+def read_all(get_loader):
+    """Stream an entire file through a loader, return the entry count."""
+
+    return sum(len(entries) for _, entries in get_loader().read())
+
+
+def same_entries(first, second):
+    """Check if two loaders produced the same timesteps and entry values."""
+
+    if len(first) != len(second):
+        return False
+
+    for (time_a, entries_a), (time_b, entries_b) in zip(first, second):
+        if time_a != time_b or len(entries_a) != len(entries_b):
+            return False
+        for a, b in zip(entries_a, entries_b):
+            if any(getattr(a, name) != getattr(b, name)
+                for name in Entry.__slots__):
+                return False
+
+    return True
+
+
+def benchmark(filename, repeats, cache_dir):
+    """Time all loaders on a file, keep the best of several repeats."""
+
+    size = os.path.getsize(filename) / 2**20
+    reference = None
+    print("{} ({:.1f} MB)".format(os.path.basename(filename), size))
+
+    # the first read of a simulation converts it to the columnar cache
+    start = time.perf_counter()
+    cache_simulation(filename, cache_dir)
+    print("  {:<20} {:8.3f} s".format("cache conversion",
+        time.perf_counter() - start))
+
+    for name, get_loader in get_loaders(filename, cache_dir):
+
+        # best wall time over all repeats
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            count = read_all(get_loader)
+            best = min(best, time.perf_counter() - start)
+
+        # compare produced entries with the first loader's
+        timesteps = list(get_loader().read())
+        if reference is None:
+            reference = timesteps
+            check = "reference"
+        else:
+            check = "same" if same_entries(reference, timesteps) else "DIFF"
+
+        print("  {:<20} {:8.3f} s {:10.0f} entries/s {:7.1f} MB/s  {}".format(
+            name, best, count / best, size / best, check))
+
+
+if __name__ == "__main__":
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    files = sys.argv[2:] or sorted(glob.glob(os.path.join(
+        os.path.dirname(__file__), '..', 'samples', '*.output*.xml')))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for filename in files:
+            benchmark(filename, repeats, cache_dir)
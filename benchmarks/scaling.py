@@ -0,0 +1,168 @@
+"""Pipeline scaling benchmark
+
+This script times each stage of the pipeline (network model construction,
+path finding, simulation parsing and MOE analysis cycles) on synthetic grid
+networks of growing size, and writes the results as JSON lines so that runs
+can be compared to find regressions and the sizes where a stage breaks.
+
+Sizes run from smallest to largest; once a stage takes longer than the time
+limit, the larger sizes are skipped.
+
+Usage:
+    python benchmarks/scaling.py [--sizes 4,8,16] [--duration 300]
+        [--density 20] [--engine object|vectorized|aggregate] [--all-paths]
+        [--max-paths N] [--limit seconds] [--output results.jsonl]
+
+"""
+
+import sys, os, json, time, argparse, platform, tempfile
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from model.network import RoadNetworkModel
+from analyzer.loaders import XmlDataLoader
+from analyzer.analyzer import MOEAnalyzer
+from analyzer.vectorized import VectorizedMOEAnalyzer, AggregateMOEAnalyzer
+from analyzer.stats import PipelineStats
+from synthetic import write_grid_network, write_grid_simulation
+
+
+ENGINES = {"object": MOEAnalyzer, "vectorized": VectorizedMOEAnalyzer,
+    "aggregate": AggregateMOEAnalyzer}
+PCE = {"car": 1, "moto": 0.5, "truck": 2, "bus": 2, "taxi": 1, "other": 1}
+
+
+class ReplayLoader():
+    """Loader of already parsed timesteps, to time the analysis alone."""
+    def __init__(self, timesteps):
+        self.timesteps = timesteps
+
+    def read(self):
+        yield from self.timesteps
+
+
+def timed(function, *args, **kwargs):
+    """Call a function, return its result and the seconds it took."""
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark(dirname, size, options):
+    """Generate a grid network and simulation of a size, time all stages."""
+
+    name = "grid-{0}x{0}".format(size)
+    network = os.path.join(dirname, name + ".net.xml")
+    simulation = os.path.join(dirname, name + ".output.xml")
+    stages = {}
+
+    write_grid_network(network, size, size)
+    _, stages["generate"] = timed(write_grid_simulation, simulation, size,
+        size, options.duration, options.density)
+
+    # model construction without paths, then path finding separately
+    model, stages["model"] = timed(RoadNetworkModel, dirname,
+        name + ".net.xml", shortest_paths=not options.all_paths,
+        max_paths=options.max_paths, lazy_paths=True)
+    routes = list(model.routes.values())
+    paths, stages["paths"] = timed(model.get_paths, model.graph, routes)
+
+    start = time.perf_counter()
+    model.path_systems = model.get_path_systems(paths)
+    for system in model.path_systems.values():
+        model.index_system(system)
+    stages["path_systems"] = time.perf_counter() - start
+
+    # parsing, then analysis of the parsed timesteps
+    timesteps, stages["parse"] = timed(list, XmlDataLoader(simulation).read())
+    entries = sum(len(entries) for _, entries in timesteps)
+
+    stats = PipelineStats()
+    analyzer = ENGINES[options.engine](model, ReplayLoader(timesteps), PCE,
+        options.rate, stats=stats)
+    cycles, stages["analyze"] = timed(lambda: sum(1
+        for _ in analyzer.get_next_metrics()))
+
+    return {
+        "size": size,
+        "network": {"edges": len(model.edges),
+            "junctions": len(model.junctions), "routes": len(routes),
+            "paths": len(model.path_systems),
+            "systems": len(model.edge_systems) + len(model.path_systems)
+                + len(model.custom_systems)},
+        "simulation": {"duration": options.duration,
+            "density": options.density, "timesteps": len(timesteps),
+            "entries": entries,
+            "megabytes": os.path.getsize(simulation) / 2**20},
+        "stages": stages,
+        "rates": {"parse_entries_per_second": entries / stages["parse"],
+            "analyze_entries_per_second": entries / stages["analyze"],
+            "cycles_per_second": cycles / stages["analyze"]},
+        "analysis": stats.to_dict()}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Time the pipeline stages "
+        "on synthetic grid networks of growing size.")
+    parser.add_argument("--sizes", default="4,8,16",
+        help="comma separated grid sizes (junctions per side)")
+    parser.add_argument("--duration", type=int, default=300,
+        help="simulated seconds")
+    parser.add_argument("--density", type=float, default=20,
+        help="vehicles per km of edges")
+    parser.add_argument("--rate", type=float, default=1,
+        help="calculation rate in seconds")
+    parser.add_argument("--engine", choices=ENGINES, default="object")
+    parser.add_argument("--all-paths", action="store_true",
+        help="find all paths instead of only shortest ones")
+    parser.add_argument("--max-paths", type=int, default=None)
+    parser.add_argument("--limit", type=float, default=300,
+        help="skip larger sizes after a stage takes this many seconds")
+    parser.add_argument("--output", default=None,
+        help="JSON lines file to append results to (default: stdout only)")
+    options = parser.parse_args()
+
+    environment = {"python": platform.python_version(),
+        "numpy": np.__version__, "machine": platform.machine(),
+        "engine": options.engine, "started": time.time()}
+
+    output = open(options.output, "a") if options.output else None
+    try:
+        with tempfile.TemporaryDirectory() as dirname:
+            limited = None
+            for size in (int(size) for size in options.sizes.split(",")):
+
+                if limited is not None:
+                    result = {"size": size, "skipped": limited}
+                else:
+                    result = benchmark(dirname, size, options)
+                    slow = [stage for stage, seconds
+                        in result["stages"].items()
+                        if stage != "generate" and seconds > options.limit]
+                    if slow:
+                        limited = "{} over {} s at size {}".format(
+                            ",".join(slow), options.limit, size)
+
+                    print("{:>4}x{:<4} {:>7} edges {:>9} entries  ".format(
+                        size, size, result["network"]["edges"],
+                        result["simulation"]["entries"]) + "  ".join(
+                        "{} {:.3f}s".format(stage, seconds)
+                        for stage, seconds in result["stages"].items()),
+                        file=sys.stderr)
+
+                line = json.dumps(dict(result, environment=environment))
+                print(line)
+                if output is not None:
+                    output.write(line + "\n")
+                    output.flush()
+
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Synthetic road networks and traffic
+
+This script generates SUMO-style road network files of rectangular grids of
+configurable size, and matching FCD simulation outputs of vehicles driving
+through them with a configurable density, for benchmarking the pipeline on
+networks larger than the samples.
+
+Grid junctions are joined by two-way streets. Every border junction also
+has a one-way street coming in from a dead end (a network entrance) and one
+going out to another (a network exit). Vehicles enter at a random entrance,
+drive a shortest path to a random exit at a constant speed and leave, so
+there is no interaction between them.
+
+Functions:
+    write_grid_network
+    write_grid_simulation
+
+Usage:
+    python benchmarks/synthetic.py rows columns [duration] [density] [dir]
+
+"""
+
+import sys, os, math, random
+
+
+# location of the grid's first junction, and meters per degree of latitude
+ORIGIN = (-79.3, 43.7)
+METERS_PER_DEGREE = 111320
+
+# driving directions (row, column steps) and the border each stub is at
+DIRECTIONS = {"n": (1, 0), "s": (-1, 0), "e": (0, 1), "w": (0, -1)}
+
+
+def get_junction_id(row, column):
+    """Get the id of a grid junction."""
+    return "J{}_{}".format(row, column)
+
+
+def get_stubs(rows, columns):
+    """Get the border junctions with entrance/exit stubs, and their side."""
+
+    stubs = []
+    for column in range(columns):
+        stubs.append((0, column, "s"))
+        stubs.append((rows - 1, column, "n"))
+    for row in range(rows):
+        stubs.append((row, 0, "w"))
+        stubs.append((row, columns - 1, "e"))
+
+    return stubs
+
+
+def get_edges(rows, columns, spacing):
+    """Get all edges of a grid, as id -> (from id, to id, start, end)."""
+
+    def position(row, column):
+        return column * spacing, row * spacing
+
+    edges = {}
+    for row in range(rows):
+        for column in range(columns):
+            start = position(row, column)
+            node = get_junction_id(row, column)
+
+            # two-way streets to the next junctions, north and east
+            for d_row, d_column in ((1, 0), (0, 1)):
+                if row + d_row < rows and column + d_column < columns:
+                    end = position(row + d_row, column + d_column)
+                    other = get_junction_id(row + d_row, column + d_column)
+                    edges[node + "to" + other] = (node, other, start, end)
+                    edges[other + "to" + node] = (other, node, end, start)
+
+    # entrance and exit stubs, half a block out of the border
+    for row, column, side in get_stubs(rows, columns):
+        node = get_junction_id(row, column)
+        start = position(row, column)
+        d_row, d_column = DIRECTIONS[side]
+        end = (start[0] + d_column * spacing / 2,
+            start[1] + d_row * spacing / 2)
+
+        edges["in" + side + node] = ("in" + side + node, node, end, start)
+        edges["out" + side + node] = (node, "out" + side + node, start, end)
+
+    return edges
+
+
+def get_lane_shape(start, end, offset = 1.6):
+    """Get a lane shape from an edge's end points, offset to the right."""
+
+    (x0, y0), (x1, y1) = start, end
+    length = math.hypot(x1 - x0, y1 - y0)
+    dx, dy = (y1 - y0) / length * offset, -(x1 - x0) / length * offset
+
+    return (x0 + dx, y0 + dy), (x1 + dx, y1 + dy)
+
+
+def write_grid_network(filename, rows, columns, spacing = 100, lanes = 1,
+    speed = 13.89):
+    """Write a grid road network file, in SUMO's .net.xml format."""
+
+    edges = get_edges(rows, columns, spacing)
+
+    # network and matching lng/lat boundaries, half a block around the grid
+    low = (-spacing / 2, -spacing / 2)
+    high = (spacing * (columns - 0.5), spacing * (rows - 0.5))
+    scale = (METERS_PER_DEGREE * math.cos(math.radians(ORIGIN[1])),
+        METERS_PER_DEGREE)
+    boundary = "{:.2f},{:.2f},{:.2f},{:.2f}".format(*low, *high)
+    geo_boundary = "{:.6f},{:.6f},{:.6f},{:.6f}".format(
+        ORIGIN[0] + low[0] / scale[0], ORIGIN[1] + low[1] / scale[1],
+        ORIGIN[0] + high[0] / scale[0], ORIGIN[1] + high[1] / scale[1])
+
+    with open(filename, "w") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n\n'
+            '<net version="1.1">\n\n')
+        file.write('    <location netOffset="0.00,0.00" convBoundary="{}" '
+            'origBoundary="{}" projParameter="!"/>\n\n'.format(boundary,
+            geo_boundary))
+
+        for edge_id, (from_id, to_id, start, end) in edges.items():
+            kind = ("primary" if edge_id.startswith(("in", "out"))
+                else "tertiary")
+            file.write('    <edge id="{}" from="{}" to="{}" priority="1" '
+                'type="highway.{}">\n'.format(edge_id, from_id, to_id, kind))
+
+            for index in range(lanes):
+                (x0, y0), (x1, y1) = get_lane_shape(start, end,
+                    1.6 + 3.2 * index)
+                file.write('        <lane id="{}_{}" index="{}" speed="{}" '
+                    'length="{:.2f}" shape="{:.2f},{:.2f} {:.2f},{:.2f}"/>\n'
+                    .format(edge_id, index, index, speed,
+                        math.hypot(x1 - x0, y1 - y0), x0, y0, x1, y1))
+
+            file.write('    </edge>\n')
+
+        # grid junctions, then the dead ends of the stubs
+        junctions = {node: (start, "priority")
+            for from_id, to_id, start, end in edges.values()
+            for node in (from_id,) if node.startswith("J")}
+        junctions.update({node: (point, "dead_end")
+            for from_id, to_id, start, end in edges.values()
+            for node, point in ((from_id, start), (to_id, end))
+            if not node.startswith("J")})
+
+        for node, ((x, y), kind) in junctions.items():
+            file.write('    <junction id="{}" type="{}" x="{:.2f}" y="{:.2f}" '
+                'incLanes="" intLanes="" shape=""/>\n'.format(node, kind, x,
+                y))
+
+        file.write('\n</net>\n')
+
+
+def get_route(rows, columns, entrance, exit):
+    """Get the edge ids of a shortest path from an entrance to an exit."""
+
+    (row, column, side), (end_row, end_column, end_side) = entrance, exit
+    route = ["in" + side + get_junction_id(row, column)]
+
+    # drive along the row first, then along the column
+    while (row, column) != (end_row, end_column):
+        node = get_junction_id(row, column)
+        if column != end_column:
+            column += 1 if end_column > column else -1
+        else:
+            row += 1 if end_row > row else -1
+        route.append(node + "to" + get_junction_id(row, column))
+
+    route.append("out" + end_side + get_junction_id(row, column))
+    return route
+
+
+def write_grid_simulation(filename, rows, columns, duration = 600,
+    density = 20, spacing = 100, lanes = 1, speed = 13.89, seed = 0):
+    """Write the FCD output of a simulation on a grid network.
+
+    The density is the number of vehicles per km of edges kept in the
+    network, new vehicles enter whenever there are fewer than that, at most
+    one at each entrance per second. Returns the number of entries written.
+    """
+
+    generator = random.Random(seed)
+    edges = get_edges(rows, columns, spacing)
+    stubs = get_stubs(rows, columns)
+
+    # shapes of the lane the model takes as the middle one of each edge
+    middle = (round(lanes / 2) - 1) % lanes
+    shapes = {edge_id: get_lane_shape(start, end, 1.6 + 3.2 * middle)
+        for edge_id, (_, _, start, end) in edges.items()}
+    lengths = {edge_id: math.hypot(x1 - x0, y1 - y0)
+        for edge_id, ((x0, y0), (x1, y1)) in shapes.items()}
+    target = density * sum(lengths.values()) / 1000
+
+    vehicles = []   # [id, type, speed, route, route index, position]
+    count = 0
+    entries = 0
+    with open(filename, "w") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n\n'
+            '<fcd-export>\n')
+
+        for time in range(duration):
+
+            # enter new vehicles at distinct random entrances
+            new = min(max(0, round(target) - len(vehicles)), len(stubs))
+            for entrance in generator.sample(stubs, new):
+                _type = generator.choices(("passenger", "truck", "bus"),
+                    (0.9, 0.07, 0.03))[0]
+                vehicles.append(["veh{}".format(count), _type,
+                    speed * generator.uniform(0.6, 1.0),
+                    get_route(rows, columns, entrance,
+                        generator.choice(stubs)), 0, 0.0])
+                count += 1
+
+            file.write('    <timestep time="{:.2f}">\n'.format(time))
+            for _id, _type, v, route, index, pos in vehicles:
+                edge_id = route[index]
+                (x0, y0), (x1, y1) = shapes[edge_id]
+                ratio = pos / lengths[edge_id]
+                file.write('        <vehicle id="{}" x="{:.2f}" y="{:.2f}" '
+                    'angle="{:.2f}" type="{}" speed="{:.2f}" pos="{:.2f}" '
+                    'lane="{}_{}" slope="0.00"/>\n'.format(_id,
+                        x0 + (x1 - x0) * ratio, y0 + (y1 - y0) * ratio,
+                        math.degrees(math.atan2(x1 - x0, y1 - y0)) % 360,
+                        _type, v, pos, edge_id, middle))
+            file.write('    </timestep>\n')
+            entries += len(vehicles)
+
+            # move vehicles on along their routes, drop those that left
+            moving = []
+            for vehicle in vehicles:
+                vehicle[5] += vehicle[2]
+                while vehicle[5] >= lengths[vehicle[3][vehicle[4]]]:
+                    vehicle[5] -= lengths[vehicle[3][vehicle[4]]]
+                    vehicle[4] += 1
+                    if vehicle[4] == len(vehicle[3]):
+                        break
+                else:
+                    moving.append(vehicle)
+            vehicles = moving
+
+        file.write('</fcd-export>\n')
+
+    return entries
+
+
+if __name__ == "__main__":
+
+    rows, columns = int(sys.argv[1]), int(sys.argv[2])
+    duration = int(sys.argv[3]) if len(sys.argv) > 3 else 600
+    density = float(sys.argv[4]) if len(sys.argv) > 4 else 20
+    dirname = sys.argv[5] if len(sys.argv) > 5 else "."
+
+    name = "grid-{}x{}".format(rows, columns)
+    write_grid_network(os.path.join(dirname, name + ".net.xml"), rows,
+        columns)
+    entries = write_grid_simulation(os.path.join(dirname,
+        name + ".output.xml"), rows, columns, duration, density)
+    print("{}: {} entries".format(name, entries))
@@ -1,4 +1,5 @@
-import re, copy
+import re
+import numpy as np
 
 class Junction():
     """Representation of a junction in a road network."""
@@ -77,14 +78,13 @@ class Shape():
     def transform(self, old, new):
         """Transform the shape points from one rectangle space to another."""
 
-        # create a copy of this Shape and loop through its points
-        new_shape = copy.deepcopy(self)
-        for index, (x, y) in enumerate(self.points):
+        # project all points at once, into a new Shape
+        old, new = np.array(old, dtype=float), np.array(new, dtype=float)
+        points = ((np.array(self.points, dtype=float).reshape(-1, 2) - old[:2])
+            * (new[2:] - new[:2]) / (old[2:] - old[:2]) + new[:2])
 
-            # project points
-            new_x = (x-old[0]) * (new[2]-new[0]) / (old[2]-old[0]) + new[0]
-            new_y = (y-old[1]) * (new[3]-new[1]) / (old[3]-old[1]) + new[1]
-            new_shape.points[index] = (new_x, new_y)
+        new_shape = Shape.__new__(Shape)
+        new_shape.points = [tuple(point) for point in points.tolist()]
 
         return new_shape
 
@@ -6,23 +6,47 @@ This file contains the main road network model class
 Classes:
     RoadNetworkModel
 
+Functions:
+    find_route_paths
+    load_cached_model
+
 """
 
 import xml.etree.ElementTree as ET
 import networkx as nx
-import re, os
+import numpy as np
+import re, os, glob, json, hashlib, pickle, inspect
+from concurrent.futures import ProcessPoolExecutor
 
 from model.base_components import *
 from model.system_components import *
+from model.spatial import EdgeIndex, project_utm
+
+
+# version of the model layout, cached models of other versions are rebuilt
+MODEL_VERSION = 4
+
+# edge types that are not allowed as network entrances or exits by default
+EXCLUDED_TYPES = {'highway.residential', 'highway.service'}
 
 
 class RoadNetworkModel():
     """Read an xml file and construct a representation of the road network"""
-    def __init__(self, fileroot, name, shortest_paths = False):
+    def __init__(self, fileroot, name, shortest_paths = False,
+        excluded_types = EXCLUDED_TYPES, max_paths = None, max_detour = None,
+        max_length = None, lazy_paths = False, workers = None):
 
         # initialize components and parse file
         self.name = name
         self.shortest_paths = shortest_paths
+        self.excluded_types = set(excluded_types)
+
+        # path enumeration limits, per route (entrance/exit pair)
+        self.max_paths = max_paths      # k shortest simple paths
+        self.max_detour = max_detour    # length ratio over the shortest path
+        self.max_length = max_length    # absolute path length in meters
+        self.lazy_paths = lazy_paths    # only find paths of requested routes
+        self.workers = workers          # processes used for path finding
 
         self.junctions = {}
         self.edges = {}
@@ -31,18 +55,35 @@ class RoadNetworkModel():
         self.graph = {}
         self.path_systems = {}
         self.custom_systems = {}
+        self.system_index = {}  # edge id -> multi-edge systems containing it
+        self.routes = {}        # route id -> (entrance, exit) junction ids
+        self.loaded_routes = set()  # ids of routes with paths found
+        self.summaries = {}     # (kind, system id) -> display summary
+        self.cache_key = None   # set when stored in the model cache
 
         # read low-level edges
         self.read_model(os.path.join(fileroot, name))
 
+        # project edge shapes for display once, they never change
+        self.geometry = self.get_geometry()
+        self.spatial_index = EdgeIndex(list(self.edges.values()))
+
         # represent as directed graph
         self.construct_graph()
 
         # get graph entrances/exits (not of these types) and paths btw. them
-        paths = self.get_paths(self.graph,
-            {'highway.residential', 'highway.service'})
+        routes = self.get_routes(self.graph, self.excluded_types)
+        self.routes = {source + "->" + target: (source, target)
+            for source, target in routes}
 
-        self.path_systems = self.get_path_systems(paths)
+        # when lazy, paths are only found for routes requested with add_route
+        if not self.lazy_paths:
+            paths = self.get_paths(self.graph, routes)
+
+            self.path_systems = self.get_path_systems(paths)
+            for system in self.path_systems.values():
+                self.index_system(system)
+            self.loaded_routes = set(self.routes)
 
         self.add_custom_system("Entire network", self.edges.keys())
 
@@ -77,17 +118,128 @@ class RoadNetworkModel():
             root.findall('location')[0].attrib['convBoundary'].split(',')]
         self.origBoundary = [float(coord) for coord in
             root.findall('location')[0].attrib['origBoundary'].split(',')]
+
+        # offset and projection from original to network coordinates
+        location = root.findall('location')[0].attrib
+        self.netOffset = [float(coord) for coord in
+            location.get('netOffset', '0,0').split(',')]
+        self.projParameter = location.get('projParameter', '!')
         
 
+    def get_geometry(self):
+        """Project all edge shapes to lng/lat coordinates as GeoJSON.
+
+        Points of all edges are projected at once, and each edge's details
+        are stored as its feature's properties.
+        """
+
+        edges = list(self.edges.values())
+        if not edges:
+            return {"type": "FeatureCollection", "features": []}
+
+        # flatten the points of all shapes, keep where each one starts
+        points = np.array([point for edge in edges
+            for point in edge.shape.points], dtype=float)
+        starts = np.cumsum([0] + [len(edge.shape.points) for edge in edges])
+
+        # project points, same operations as Shape.transform
+        old = np.array(self.convBoundary)
+        new = np.array(self.origBoundary)
+        projected = ((points - old[:2]) * (new[2:] - new[:2])
+            / (old[2:] - old[:2]) + new[:2]).tolist()
+
+        features = [{"type": "Feature", "id": edge.id,
+                "geometry": {"type": "LineString",
+                    "coordinates": projected[starts[i]:starts[i+1]]},
+                "properties": {
+                    "type": edge.type,
+                    "lanes": len(edge.lanes),
+                    "speed": round(edge.flow_speed * 3.6),
+                    "length": edge.length,
+                    "order": edge.shape.get_center()[0]}}
+            for i, edge in enumerate(edges)]
+
+        return {"type": "FeatureCollection", "features": features}
+
+
+    def to_network(self, lng, lat):
+        """Project lng/lat coordinates to network x/y coordinates.
+
+        Networks converted with a UTM projection are projected exactly, the
+        way they were converted, others by their coordinate boundaries.
+        """
+
+        zone = re.search(r'\+zone=(\d+)', self.projParameter)
+        if '+proj=utm' not in self.projParameter or zone is None:
+            return self.from_map(lng, lat)
+
+        x, y = project_utm(lng, lat, int(zone.group(1)),
+            '+south' in self.projParameter)
+
+        return x + self.netOffset[0], y + self.netOffset[1]
+
+
+    def from_map(self, lng, lat):
+        """Project map lng/lat coordinates back to network x/y coordinates.
+
+        This is the inverse of the boundary mapping used for displaying the
+        network, not the original projection of the network.
+        """
+
+        old, new = self.origBoundary, self.convBoundary
+        return ((lng - old[0]) * (new[2] - new[0]) / (old[2] - old[0])
+            + new[0], (lat - old[1]) * (new[3] - new[1]) / (old[3] - old[1])
+            + new[1])
+
+
+    def edges_in_bounds(self, west, south, east, north):
+        """Get the ids of edges crossing a map lng/lat bounding box."""
+
+        xmin, ymin = self.from_map(west, south)
+        xmax, ymax = self.from_map(east, north)
+
+        return self.spatial_index.query_bbox(min(xmin, xmax), min(ymin, ymax),
+            max(xmin, xmax), max(ymin, ymax))
+
+
+    def nearest_edge(self, x, y, max_distance = None, geographic = False):
+        """Find the edge nearest to a point, in network or lng/lat coordinates.
+
+        Returns the edge id, the distance to it in meters and the position
+        along the edge, or None if no edge is within the maximum distance.
+        """
+
+        if geographic:
+            x, y = self.to_network(x, y)
+
+        return self.spatial_index.nearest(x, y, max_distance)
+
+
+    def get_summary(self, kind, system):
+        """Get the length and edge list of a multi-edge system, computed once.
+        """
+
+        key = (kind, system.id)
+        if key not in self.summaries:
+            self.summaries[key] = {
+                'length': round(sum(edge_system.edge.length
+                    for edge_system in system.edge_systems.values()), 1),
+                'edges': ','.join(str(edge_system.edge.id)
+                    for edge_system in system.edge_systems.values())}
+
+        return self.summaries[key]
+
+
     def construct_graph(self):
         """Create a directed graph representation fo the system."""
 
-        self.graph = nx.DiGraph([(edge.from_id, edge.to_id, {'edge': edge})
+        self.graph = nx.DiGraph([(edge.from_id, edge.to_id,
+            {'edge': edge, 'length': edge.length})
             for edge in self.edges.values()])
 
 
-    def get_paths(self, G, excluded_types={}):
-        """Get all simple paths from entrances to exits of a given graph."""
+    def get_routes(self, G, excluded_types={}):
+        """Get all combinations of entrances and exits of a given graph."""
 
         all_entrances = {node for node, in_degree in self.graph.in_degree()
             if in_degree == 0}
@@ -109,23 +261,27 @@ class RoadNetworkModel():
                 .issubset(excluded_types))}    # only connected to excl. types
 
         # get all combinations of entrances and exits
-        routes = ((source, target) for source in filtered_entrances
-            for target in filtered_exits)
-            
-        # find all paths
-        if not self.shortest_paths:
-            
-            # get all simple paths, groupped by route, as sequences of nodes
-            pathlist = (nx.all_simple_paths(G, source, target)
-                for (source, target) in routes)
+        return [(source, target) for source in filtered_entrances
+            for target in filtered_exits]
+
+
+    def get_route_paths(self, G, source, target):
+        """Get the paths of a single route, within the enumeration limits."""
+
+        return find_route_paths(G, source, target, self.shortest_paths,
+            self.max_paths, self.max_detour, self.max_length)
+
+
+    def get_paths(self, G, routes):
+        """Get paths from entrances to exits of a given graph, by route."""
 
-        # find only shortest paths
+        # find paths, groupped by route, in worker processes if configured
+        if self.workers is not None and self.workers > 1 and len(routes) > 1:
+            pathlist = self.get_paths_parallel(G, routes)
         else:
-            pathlist = ([nx.shortest_path(G, source, target)]
-                for (source, target) in routes
-                if nx.has_path(G, source, target))
+            pathlist = (self.get_route_paths(G, source, target)
+                for (source, target) in routes)
 
-        
         # flatten list and key paths by source-target pair 
         # (for paths with same source and target, also use incremental id)
         paths = {}
@@ -144,6 +300,23 @@ class RoadNetworkModel():
         return paths
 
         
+    def get_paths_parallel(self, G, routes):
+        """Find the paths of all routes in a pool of worker processes."""
+
+        # workers get a read-only copy of the bare graph, without components
+        graph = nx.DiGraph()
+        graph.add_edges_from((u, v, {'length': data['length']})
+            for u, v, data in G.edges(data=True))
+        limits = (self.shortest_paths, self.max_paths, self.max_detour,
+            self.max_length)
+
+        # map preserves route order, so merged results are deterministic
+        with ProcessPoolExecutor(self.workers, initializer=init_path_worker,
+            initargs=(graph, limits)) as executor:
+            return list(executor.map(find_worker_paths, routes,
+                chunksize=max(1, len(routes) // (self.workers * 4))))
+
+        
     def get_path_systems(self, paths):
         """Construct path system objects based on a set of paths."""
 
@@ -173,10 +346,157 @@ class RoadNetworkModel():
 
 
     def add_custom_system(self, name, edges):
-        """Add a user-created multi-edge system to the model."""
+        """Add a user-created multi-edge system to the model, return it."""
 
-        # create system, assign incremental id based on custom systems count
-        system = CustomSystem( len(self.custom_systems),
+        # create system, assign incremental id after the last custom system
+        system = CustomSystem(max(self.custom_systems, default=-1) + 1,
                 (self.edge_systems[edge_id] for edge_id in edges), name)
 
-        self.custom_systems[system.id] = system
\ No newline at end of file
+        self.custom_systems[system.id] = system
+        self.index_system(system)
+
+        return system
+
+
+    def remove_custom_system(self, system_id):
+        """Remove a user-created multi-edge system from the model, return it.
+        """
+
+        system = self.custom_systems.pop(system_id)
+        self.summaries.pop(('group', system_id), None)
+
+        # unregister it from the edges it contains
+        for edge_id in system.edges:
+            systems = self.system_index[edge_id]
+            systems.remove(system)
+            if not systems:
+                del self.system_index[edge_id]
+
+        return system
+
+
+    def add_route(self, route_id):
+        """Find the paths of a route and add their path systems to the model."""
+
+        # construct path systems for new paths, keep already existing ones
+        paths = self.get_paths(self.graph, [self.routes[route_id]])
+        path_systems = self.get_path_systems({path_id: path
+            for path_id, path in paths.items()
+            if path_id not in self.path_systems})
+
+        for system in path_systems.values():
+            self.path_systems[system.id] = system
+            self.index_system(system)
+
+        self.loaded_routes.add(route_id)
+        return path_systems
+
+
+    def index_system(self, system):
+        """Register a multi-edge system under each of the edges it contains."""
+
+        for edge_id in system.edges:
+            self.system_index.setdefault(edge_id, []).append(system)
+
+
+
+def find_route_paths(G, source, target, shortest_paths=False, max_paths=None,
+    max_detour=None, max_length=None):
+    """Get the paths of a single route of a graph, within the given limits."""
+
+    # find only shortest paths
+    if shortest_paths:
+        if nx.has_path(G, source, target):
+            return [nx.shortest_path(G, source, target)]
+        return []
+
+    # find all paths, as sequences of nodes
+    if max_paths is None and max_detour is None and max_length is None:
+        return list(nx.all_simple_paths(G, source, target))
+
+    if not nx.has_path(G, source, target):
+        return []
+
+    # otherwise go through simple paths from shortest to longest, lazily,
+    # and stop at the first one over the limits
+    paths = []
+    shortest = None
+    for path in nx.shortest_simple_paths(G, source, target, 'length'):
+
+        length = sum(G[u][v]['length'] for u, v in nx.utils.pairwise(path))
+        if shortest is None:
+            shortest = length
+
+        if ((max_length is not None and length > max_length)
+            or (max_detour is not None and length > shortest * max_detour)):
+            break
+
+        paths.append(path)
+        if max_paths is not None and len(paths) >= max_paths:
+            break
+
+    return paths
+
+
+# graph and enumeration limits of a path finding worker process
+_path_worker = {}
+
+
+def init_path_worker(graph, limits):
+    """Store the graph and limits in a path finding worker process."""
+
+    _path_worker['graph'] = graph
+    _path_worker['limits'] = limits
+
+
+def find_worker_paths(route):
+    """Get the paths of a single route in a path finding worker process."""
+
+    source, target = route
+    return find_route_paths(_path_worker['graph'], source, target,
+        *_path_worker['limits'])
+
+
+def load_cached_model(fileroot, name, cache_dir, **options):
+    """Get a road network model from the disk cache, building it if needed.
+
+    Cached models are keyed by the content hash of the network file and the
+    model construction options, so changes to either invalidate them.
+    """
+
+    # hash network file contents and construction options (with defaults)
+    with open(os.path.join(fileroot, name), 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()[:16]
+    arguments = inspect.signature(RoadNetworkModel).bind(fileroot, name,
+        **options)
+    arguments.apply_defaults()
+    settings = dict(list(arguments.arguments.items())[2:])
+    settings.pop('workers')     # doesn't affect the built model
+    settings['version'] = MODEL_VERSION
+    key = hashlib.sha256(json.dumps(settings, sort_keys=True,
+        default=sorted).encode()).hexdigest()[:16]
+    filename = os.path.join(cache_dir, '{}.{}.{}.pickle'.format(name,
+        digest, key))
+
+    # load previously built model if it exists
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as file:
+            return pickle.load(file)
+
+    # otherwise build it and remove models cached for older file versions
+    model = RoadNetworkModel(fileroot, name, **options)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(glob.escape(cache_dir),
+        glob.escape(name) + '.*.pickle')):
+        if os.path.basename(stale).split('.')[-3] != digest:
+            os.remove(stale)
+
+    # key of this model version, for caching anything derived from it
+    model.cache_key = digest + '.' + key
+
+    # write through a temporary file so readers never see partial models
+    with open(filename + '.tmp', 'wb') as file:
+        pickle.dump(model, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+    return model
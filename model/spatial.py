@@ -0,0 +1,330 @@
+"""Road network spatial index
+
+This file contains a uniform grid index over the segments of all edge
+shapes, for finding the edges in a bounding box or the edge nearest to a
+point (e.g. to match probe positions to edges) without scanning every edge.
+
+Classes:
+    EdgeIndex
+
+Functions:
+    project_utm
+
+"""
+
+import numpy as np
+
+
+# WGS84 ellipsoid and UTM constants
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+UTM_SCALE = 0.9996
+
+
+def project_utm(lon, lat, zone, south = False):
+    """Project WGS84 lon/lat degrees to UTM easting/northing in meters.
+
+    Uses the Krueger series of the transverse Mercator projection, which is
+    accurate to well below a millimeter within a zone. Works on arrays.
+    """
+
+    n = WGS84_F / (2 - WGS84_F)
+    radius = WGS84_A / (1 + n) * (1 + n**2 / 4 + n**4 / 64)
+    alpha = (n/2 - 2*n**2/3 + 5*n**3/16, 13*n**2/48 - 3*n**3/5, 61*n**3/240)
+
+    phi = np.radians(lat)
+    lam = np.radians(lon) - np.radians((zone - 1) * 6 - 180 + 3)
+
+    # conformal latitude, then transverse Mercator coordinates on a sphere
+    e = 2 * np.sqrt(n) / (1 + n)
+    t = np.sinh(np.arctanh(np.sin(phi)) - e * np.arctanh(e * np.sin(phi)))
+    xi = np.arctan2(t, np.cos(lam))
+    eta = np.arctanh(np.sin(lam) / np.sqrt(1 + t**2))
+
+    easting = eta + sum(a * np.cos(2*j*xi) * np.sinh(2*j*eta)
+        for j, a in enumerate(alpha, 1))
+    northing = xi + sum(a * np.sin(2*j*xi) * np.cosh(2*j*eta)
+        for j, a in enumerate(alpha, 1))
+
+    return (500000 + UTM_SCALE * radius * easting,
+        (10000000 if south else 0) + UTM_SCALE * radius * northing)
+
+
+class EdgeIndex():
+    """Uniform grid over edge shape segments, in network coordinates.
+
+    Every segment is listed in each grid cell its bounding box overlaps, and
+    the cell size is chosen so that cells hold a few segments on average.
+    """
+    def __init__(self, edges, cell_size = None):
+
+        self.edge_ids = []
+        segments = []
+        offsets = []    # distance along the shape at each segment's start
+        for e, edge in enumerate(edges):
+            self.edge_ids.append(edge.id)
+
+            # single point shapes become a segment of zero length
+            points = edge.shape.points
+            points = points if len(points) > 1 else points * 2
+
+            offset = 0
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                segments.append((x0, y0, x1, y1, e))
+                offsets.append(offset)
+                offset += ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+
+        segments = np.array(segments, dtype=float).reshape(-1, 5)
+        self.start = segments[:, 0:2]
+        self.end = segments[:, 2:4]
+        self.edge = segments[:, 4].astype(np.int64)
+        self.offset = np.array(offsets, dtype=float)
+
+        # total shape length of each edge, to scale positions to edge length
+        self.shape_length = np.zeros(len(self.edge_ids))
+        np.add.at(self.shape_length, self.edge,
+            np.linalg.norm(self.end - self.start, axis=1))
+        self.edge_length = np.array([edge.length for edge in edges],
+            dtype=float)
+
+        # segment bounding boxes
+        self.low = np.minimum(self.start, self.end)
+        self.high = np.maximum(self.start, self.end)
+
+        if len(self.edge) == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = cell_size or 1.0
+            self.shape = np.ones(2, dtype=np.int64)
+            self.cell_start = np.zeros(2, dtype=np.int64)
+            self.cell_segments = np.zeros(0, dtype=np.int64)
+            return
+
+        # by default, aim for about one segment per cell over the whole area
+        self.origin = self.low.min(axis=0)
+        extent = np.maximum(self.high.max(axis=0) - self.origin, 1e-9)
+        self.cell_size = cell_size or max(float(np.sqrt(
+            extent[0] * extent[1] / len(self.edge))), 1e-3)
+        self.shape = (extent // self.cell_size).astype(np.int64) + 1
+
+        # list segments by cell, as CSR arrays sorted by cell number
+        low = self.get_cells(self.low)
+        high = self.get_cells(self.high)
+        cells = []
+        members = []
+        for s, ((cx0, cy0), (cx1, cy1)) in enumerate(zip(low.tolist(),
+            high.tolist())):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cells.append(cx * self.shape[1] + cy)
+                    members.append(s)
+
+        cells = np.array(cells, dtype=np.int64)
+        order = np.argsort(cells, kind='stable')
+        self.cell_segments = np.array(members, dtype=np.int64)[order]
+        self.cell_start = np.searchsorted(cells[order],
+            np.arange(self.shape[0] * self.shape[1] + 1))
+
+
+    def get_cells(self, points):
+        """Get the (clipped) grid cell coordinates of points."""
+
+        cells = ((np.asarray(points, dtype=float) - self.origin)
+            // self.cell_size).astype(np.int64)
+
+        return np.clip(cells, 0, self.shape - 1)
+
+
+    def get_segments(self, low, high):
+        """Get the indices of segments listed in a range of grid cells."""
+
+        (cx0, cy0), (cx1, cy1) = low, high
+        columns = self.shape[1]
+        found = [self.cell_segments[self.cell_start[cx * columns + cy0]:
+                self.cell_start[cx * columns + cy1 + 1]]
+            for cx in range(cx0, cx1 + 1)]
+
+        return np.unique(np.concatenate(found)) if found else \
+            np.zeros(0, dtype=np.int64)
+
+
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        """Get the ids of edges with a segment crossing a bounding box."""
+
+        if len(self.edge) == 0:
+            return []
+
+        segments = self.get_segments(*self.get_cells([(xmin, ymin),
+            (xmax, ymax)]).tolist())
+
+        # keep segments whose bounding box overlaps the given one
+        low, high = self.low[segments], self.high[segments]
+        overlaps = ((low[:, 0] <= xmax) & (high[:, 0] >= xmin)
+            & (low[:, 1] <= ymax) & (high[:, 1] >= ymin))
+
+        return [self.edge_ids[e]
+            for e in np.unique(self.edge[segments[overlaps]]).tolist()]
+
+
+    def nearest(self, x, y, max_distance = None):
+        """Find the edge nearest to a point.
+
+        Returns the edge id, the distance to it and the position of the
+        closest point along the edge (scaled to the edge length), or None
+        if there is no edge within the maximum distance.
+        """
+
+        if len(self.edge) == 0:
+            return None
+
+        point = np.array((x, y), dtype=float)
+        center = ((point - self.origin) // self.cell_size).astype(np.int64)
+
+        # search growing rings of cells around it, starting from the nearest
+        # ring that overlaps the grid, until no closer segment can exist
+        ring = int(max(0, (-center).max(), (center - self.shape + 1).max()))
+        best = None
+        while True:
+            low = np.clip(center - ring, 0, self.shape - 1)
+            high = np.clip(center + ring, 0, self.shape - 1)
+            segments = self.get_segments(low.tolist(), high.tolist())
+
+            if len(segments):
+                distance, t = self.project(point, segments)
+                closest = int(np.argmin(distance))
+                if best is None or distance[closest] < best[1]:
+                    best = (segments[closest], distance[closest], t[closest])
+
+            # segments in cells not searched yet are at least this far, on
+            # sides of the searched cells not at the grid border
+            reach = np.concatenate((
+                np.where(low > 0, point - self.origin - low * self.cell_size,
+                    np.inf),
+                np.where(high < self.shape - 1, self.origin
+                    + (high + 1) * self.cell_size - point, np.inf))).min()
+
+            if best is not None and best[1] <= reach or reach == np.inf:
+                break
+            if max_distance is not None and reach > max_distance:
+                break
+            ring += 1
+
+        if best is None or (max_distance is not None
+            and best[1] > max_distance):
+            return None
+
+        segment, distance, t = best
+        return (self.edge_ids[self.edge[segment]], float(distance),
+            float(self.get_positions(segment, t)))
+
+
+    def match(self, points, max_distance, headings = None):
+        """Find the nearest edge of many points at once.
+
+        Only edges within the maximum distance are searched, by checking the
+        grid cells around each point. With headings (degrees clockwise from
+        north, NaN if unknown), segments pointing more than 90 degrees away
+        are skipped, to tell apart the two directions of a road. Returns
+        arrays of the edge index (-1 if there is no edge close enough), the
+        distance to it and the position along it (scaled to edge length).
+        """
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        count = len(points)
+        best_segment = np.zeros(count, dtype=np.int64)
+        best_distance = np.full(count, np.inf)
+        best_t = np.zeros(count)
+
+        # unit vectors of the headings, zero if unknown
+        if headings is not None:
+            headings = np.radians(np.asarray(headings, dtype=float))
+            heading = np.nan_to_num(np.column_stack((np.sin(headings),
+                np.cos(headings))))
+
+        # range of cells within the maximum distance of each point
+        if len(self.edge) and count:
+            low = self.get_cells(points - max_distance)
+            high = self.get_cells(points + max_distance)
+            spans = (high - low).max(axis=0)
+        else:
+            spans = (-1, -1)
+
+        columns = self.shape[1]
+        for dx in range(spans[0] + 1):
+            for dy in range(spans[1] + 1):
+                cells = low + (dx, dy)
+                inside = np.flatnonzero((cells <= high).all(axis=1))
+                cell = cells[inside, 0] * columns + cells[inside, 1]
+
+                # pair points with every segment listed in their cell, pairs
+                # of each point are contiguous
+                starts = self.cell_start[cell]
+                counts = self.cell_start[cell + 1] - starts
+                rows = np.repeat(np.arange(len(inside)), counts)
+                offsets = np.arange(len(rows)) - np.repeat(
+                    np.cumsum(counts) - counts, counts)
+                segments = self.cell_segments[starts[rows] + offsets]
+                rows = inside[rows]
+
+                distance, t = self.project(points[rows], segments)
+                if headings is not None:
+                    direction = self.end[segments] - self.start[segments]
+                    opposite = (direction * heading[rows]).sum(axis=1) < 0
+                    distance[opposite] = np.inf
+
+                # keep the closest pair of each point, if closer than before
+                groups = np.flatnonzero(counts)
+                if len(groups) == 0:
+                    continue
+                bounds = np.concatenate(([0], np.cumsum(counts[groups])))
+                closest = np.minimum.reduceat(distance, bounds[:-1])
+                first = np.flatnonzero(distance == np.repeat(closest,
+                    counts[groups]))
+                first = first[np.searchsorted(first, bounds[:-1])]
+                first = first[distance[first] < best_distance[rows[first]]]
+
+                best_segment[rows[first]] = segments[first]
+                best_distance[rows[first]] = distance[first]
+                best_t[rows[first]] = t[first]
+
+        # positions along the edges of points close enough to one
+        matched = best_distance <= max_distance
+        segments = best_segment[matched]
+        edges = np.full(count, -1, dtype=np.int64)
+        edges[matched] = self.edge[segments]
+        pos = np.zeros(count)
+        pos[matched] = self.get_positions(segments, best_t[matched])
+
+        return edges, best_distance, pos
+
+
+    def get_positions(self, segments, t):
+        """Get positions along edges, from fractions of their segments."""
+
+        e = self.edge[segments]
+        pos = self.offset[segments] + t * np.linalg.norm(self.end[segments]
+            - self.start[segments], axis=-1)
+
+        # scale shape lengths to the edges' nominal length
+        scale = np.divide(self.edge_length[e], self.shape_length[e],
+            where=self.shape_length[e] > 0, out=np.ones(np.shape(e)))
+
+        return pos * scale
+
+
+    def project(self, point, segments):
+        """Get the distance from a point to segments, and where it projects.
+
+        Projections are given as the fraction of each segment's length from
+        its start point. Either a single point or one per segment is given.
+        """
+
+        start, end = self.start[segments], self.end[segments]
+        direction = end - start
+        squared = (direction ** 2).sum(axis=1)
+
+        t = np.divide(((point - start) * direction).sum(axis=1), squared,
+            where=squared > 0, out=np.zeros(len(segments)))
+        t = np.clip(t, 0, 1)
+        closest = start + t[:, None] * direction
+
+        return np.linalg.norm(point - closest, axis=1), t
@@ -10,9 +10,21 @@ Classes:
 
 """
 
+import sys
+
+
+# pce class of each known vehicle type, any other type uses "other"
+PCE_CLASSES = {"passenger": "car", "DEFAULT_VEHTYPE": "car",
+    "veh_passenger": "car", "motorcycle": "moto", "veh_motorcycle": "moto",
+    "truck": "truck", "veh_truck": "truck", "bus": "bus", "veh_bus": "bus",
+    "taxi": "taxi", "veh_taxi": "taxi"}
+
 
 class Vehicle():
     """Representation of a single vehicle."""
+
+    __slots__ = ('id', 'type', 'multiplier', 'last_entry', 'new_entry')
+
     def __init__(self, entry, pce):
 
         # vehicle properties
@@ -20,19 +32,7 @@ class Vehicle():
         self.type = entry.type
 
         # set pce multiplier based on type
-        if self.type in ["passenger", "DEFAULT_VEHTYPE", "veh_passenger"]:
-            self.multiplier = pce["car"]
-        elif self.type in ["motorcycle", "veh_motorcycle"]:
-            self.multiplier = pce["moto"]
-        elif self.type in ["truck", "veh_truck"]:
-            self.multiplier = pce["truck"]
-        elif self.type in ["bus", "veh_bus"]:
-            self.multiplier = pce["bus"]
-        elif self.type in ["taxi", "veh_taxi"]:
-            self.multiplier = pce["taxi"]
-        else:
-            self.multiplier = pce["other"]
-            
+        self.multiplier = pce[PCE_CLASSES.get(self.type, "other")]
 
         self.last_entry = None
         self.new_entry = entry
@@ -63,16 +63,19 @@ class Vehicle():
 
 class Entry():
     """Representation of a single timestep sensor entry of a vehicle."""
+
+    __slots__ = ('id', 'type', 'time', 'edge_id', 'lane_id', 'pos', 'speed')
+
     def __init__(self, entry, time):
 
-        # vehicle properties
-        self.id = entry['id']
-        self.type = entry['type']
+        # vehicle properties, repeated strings are shared between entries
+        self.id = sys.intern(entry['id'])
+        self.type = sys.intern(entry['type'])
         self.time = time
 
-        # extract edge and lane ids
-        self.edge_id = entry['lane'].rpartition('_')[0]
-        self.lane_id = entry['lane'].rpartition('_')[1]
+        # extract edge id and lane index
+        self.edge_id, _, self.lane_id = entry['lane'].rpartition('_')
+        self.edge_id = sys.intern(self.edge_id)
 
         # store position in edge
         self.pos = float(entry['pos'])
@@ -83,6 +86,23 @@ class Entry():
         # self.y = float(entry['y'])
 
 
+    @classmethod
+    def from_values(cls, _id, _type, time, edge_id, lane_id, pos, speed):
+        """Create an entry directly from already parsed values."""
+
+        entry = cls.__new__(cls)
+
+        entry.id = _id
+        entry.type = _type
+        entry.time = time
+        entry.edge_id = edge_id
+        entry.lane_id = lane_id
+        entry.pos = pos
+        entry.speed = speed
+
+        return entry
+
+
     def __repr__(self):
         return ('{}({})'.format(self.__class__.__name__, self.id))
         
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Tests of the metric calculation engines."""
+
+import os, sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ROOT)
+from model.network import RoadNetworkModel
+from analyzer.loaders import XmlDataLoader, cache_simulation
+from analyzer.analyzer import MOEAnalyzer
+from analyzer.vectorized import VectorizedMOEAnalyzer, AggregateMOEAnalyzer
+from analyzer.parallel import ParallelMOEAnalyzer
+
+
+# sums of powers of two, so parallel sums don't depend on their order
+PCE = {"car": 1, "moto": 0.5, "truck": 3.5, "bus": 3.5, "taxi": 1,
+    "other": 1}
+
+SAMPLES = [("kennedy.net.xml", "kennedy.output.xml"),
+    ("roundabout.net.xml", "roundabout.output-light-traffic.xml")]
+
+
+def get_model(network):
+    """Load a sample road network model."""
+    return RoadNetworkModel(os.path.join(ROOT, "ui", "data", "networks"),
+        network)
+
+
+def get_loader(simulation, cache_dir):
+    """Get a columnar loader of a sample simulation."""
+    return cache_simulation(os.path.join(ROOT, "ui", "data", "simulations",
+        simulation), str(cache_dir))
+
+
+@pytest.mark.parametrize("network, simulation", SAMPLES)
+def test_parallel_matches_serial(network, simulation, tmp_path):
+    """Stitched windows give the serial metrics, first cycle included."""
+
+    model = get_model(network)
+    serial = list(VectorizedMOEAnalyzer(model, get_loader(simulation,
+        tmp_path), PCE, 2).get_next_metrics())
+    parallel = list(ParallelMOEAnalyzer(model, get_loader(simulation,
+        tmp_path), PCE, 2, workers=2, shards=4).get_next_metrics())
+
+    assert parallel == serial
+
+
+def assert_close(metrics, expected, tolerance):
+    """Assert that metrics match up to a relative and absolute tolerance.
+
+    Differences of sums that cancel out can be a few ulps from zero.
+    """
+
+    assert len(metrics) == len(expected)
+    for (cycle, time), (expected_cycle, expected_time) in zip(metrics,
+        expected):
+        assert time == expected_time
+        for systems, expected_systems in zip(cycle, expected_cycle):
+            assert list(systems) == list(expected_systems)
+            for _id, values in systems.items():
+                for metric, value in values.items():
+                    other = expected_systems[_id][metric]
+                    assert (value is None) == (other is None)
+                    if value is not None:
+                        assert value == pytest.approx(other,
+                            rel=tolerance, abs=tolerance)
+
+
+@pytest.mark.parametrize("network, simulation", SAMPLES)
+def test_engines_match(network, simulation, tmp_path):
+    """Array engines give the metrics of the per-object calculation."""
+
+    # pce values that aren't powers of two, sums depend on their order
+    pce = dict(PCE, truck=2.7, bus=2.5, car=1.1)
+    metrics = {}
+    for engine in (MOEAnalyzer, VectorizedMOEAnalyzer, AggregateMOEAnalyzer):
+        metrics[engine] = list(engine(get_model(network),
+            XmlDataLoader(os.path.join(ROOT, "ui", "data", "simulations",
+                simulation)), pce, 2).get_next_metrics())
+
+    assert len(metrics[MOEAnalyzer]) > 1
+    assert metrics[VectorizedMOEAnalyzer] == metrics[MOEAnalyzer]
+    assert_close(metrics[AggregateMOEAnalyzer], metrics[MOEAnalyzer], 1e-12)
@@ -0,0 +1,160 @@
+"""Tests of the web UI backend endpoints."""
+
+import os, sys, re, json, shutil
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "ui"))
+import backend
+
+
+PARAMETERS = {"simulation": "kennedy.output.xml", "pce_car": "1",
+    "pce_moto": "0.5", "pce_truck": "3.5", "pce_bus": "3.5", "pce_taxi": "1",
+    "pce_other": "1", "hide_internals": "true"}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A test client serving the kennedy sample from a temporary data dir."""
+
+    for folder, name in (("networks", "kennedy.net.xml"),
+        ("simulations", "kennedy.output.xml")):
+        os.makedirs(tmp_path / "data" / folder)
+        shutil.copy(os.path.join(ROOT, "ui", "data", folder, name),
+            tmp_path / "data" / folder / name)
+
+    monkeypatch.chdir(tmp_path)
+    backend.models.clear()
+    backend.changes.clear()
+
+    client = backend.app.test_client()
+    client.model_id = load_page(client)
+    return client
+
+
+def load_page(client):
+    """Load the kennedy network in a new page, return its model token."""
+
+    response = client.get("/config", query_string={"network": "kennedy.net.xml"})
+    return re.search(r'data-model-id="(\w+)"', response.text).group(1)
+
+
+def get_stream(client, model_id = None, **parameters):
+    """Get the streamed metrics of all cycles."""
+
+    response = client.get("/metrics_stream", query_string=dict(PARAMETERS,
+        model=model_id or client.model_id, **parameters))
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.data.splitlines()]
+
+
+def remove_store(tmp_path):
+    """Remove stored runs, so the next stream is calculated again."""
+
+    for suffix in ("", "-wal", "-shm"):
+        filename = tmp_path / "data" / "cache" / ("metrics.db" + suffix)
+        if filename.exists():
+            filename.unlink()
+
+
+def test_repeated_streams_match(client, tmp_path):
+    """Runs on the same session model don't inherit earlier counters."""
+
+    get_stream(client, obs_rate="2")
+    first = get_stream(client, obs_rate="3")
+
+    remove_store(tmp_path)
+    second = get_stream(client, obs_rate="3")
+
+    assert len(first) > 1
+    assert first == second
+
+
+def test_derived_stream_matches(client, tmp_path):
+    """Streams derived after adding a group match a whole new analysis."""
+
+    get_stream(client, obs_rate="3")
+    edges = sorted(backend.models[client.model_id].edge_systems)[:3]
+    response = client.post("/groups", query_string={"model": client.model_id},
+        json={"name": "test", "edges": edges})
+    assert response.status_code == 201
+    group = str(response.get_json()["id"])
+
+    derived = get_stream(client, obs_rate="3")
+    stored = get_stream(client, obs_rate="3")
+
+    remove_store(tmp_path)
+    calculated = get_stream(client, obs_rate="3")
+
+    assert len(derived) > 1
+    assert all(group in cycle["groups"] for cycle in derived[1:])
+    assert derived == stored == calculated
+
+
+def test_pages_keep_own_models(client):
+    """Pages of the same browser session don't change each other's model."""
+
+    other = load_page(client)
+    edges = sorted(backend.models[other].edge_systems)[:3]
+    response = client.post("/groups", query_string={"model": other},
+        json={"name": "test", "edges": edges})
+    assert response.status_code == 201
+    group = response.get_json()["id"]
+
+    assert other != client.model_id
+    assert group in backend.models[other].custom_systems
+    assert group not in backend.models[client.model_id].custom_systems
+    assert str(group) in get_stream(client, other, obs_rate="3")[1]["groups"]
+    assert str(group) not in get_stream(client, obs_rate="3")[1]["groups"]
+
+
+def test_entire_network_group_kept(client):
+    """The built-in entire network group can't be removed, others can."""
+
+    page = client.get("/config", query_string={"network": "kennedy.net.xml"})
+    model_id = re.search(r'data-model-id="(\w+)"', page.text).group(1)
+    rows = dict(re.findall(r'data-group-id="(\d+)"(.*?)</tr>', page.text,
+        re.DOTALL))
+    assert "remove_group" not in rows["0"]
+
+    edges = sorted(backend.models[model_id].edge_systems)[:3]
+    group = client.post("/groups", query_string={"model": model_id},
+        json={"name": "test", "edges": edges}).get_json()["id"]
+
+    assert client.delete("/groups/0",
+        query_string={"model": model_id}).status_code == 400
+    assert client.delete("/groups/{}".format(group),
+        query_string={"model": model_id}).status_code == 200
+    assert list(backend.models[model_id].custom_systems) == [0]
+
+
+def test_geometry_url_shared_by_pages(client):
+    """Pages of the same network get the same, cacheable geometry."""
+
+    urls = [re.search(r'data-geometry-url="([^"]+)"',
+            client.get("/config", query_string={"network": "kennedy.net.xml"})
+            .text).group(1).replace("&amp;", "&") for _ in range(2)]
+    assert urls[0] == urls[1]
+
+    response = client.get(urls[0])
+    assert response.status_code == 200
+    assert response.get_json()["features"]
+
+    backend.models.clear()
+    assert client.get(urls[0], headers={"If-None-Match":
+        response.headers["ETag"]}).status_code == 304
+
+
+def test_live_stream_sends_rollups(client):
+    """New analyses stream rollups too when the cycles don't fit in points."""
+
+    live = get_stream(client, obs_rate="1", points="20")
+    stored = get_stream(client, obs_rate="1", points="20")
+    cycles = get_stream(client, obs_rate="1")
+
+    assert 1 < len(live) <= 20 < len(cycles)
+    assert all(cycle["time"] % 60 == 0 for cycle in live)
+    assert set(live[1]["groups"]["0"]["tti"]) == {"min", "mean", "max"}
+    assert live == stored
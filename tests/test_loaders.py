@@ -0,0 +1,132 @@
+"""Tests of the vehicle entry data loaders."""
+
+import os, sys, shutil, itertools
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ROOT)
+from model.network import RoadNetworkModel
+from analyzer.loaders import (XmlDataLoader, LiveDataLoader, TailDataLoader,
+    ProbeDataLoader, cache_simulation)
+
+
+SIMULATION = os.path.join(ROOT, "ui", "data", "simulations",
+    "kennedy.output.xml")
+
+
+def write_probes(filename, malformed = ()):
+    """Write the vehicle positions of the simulation as probe points.
+
+    The simulation's x and y are lon/lat degrees. Lines in malformed are
+    written right after the first point. Returns the edge of every point,
+    by time and vehicle id.
+    """
+
+    edges = {}
+    with open(filename, "w") as file:
+        file.write("time;id;type;speed;lon;lat\n")
+        for _, elem in ET.iterparse(SIMULATION):
+            if elem.tag == "timestep":
+                for vehicle in elem:
+                    file.write(";".join([elem.get("time")] + [vehicle.get(name)
+                        for name in ("id", "type", "speed", "x", "y")]) + "\n")
+                    edges[(float(elem.get("time")), vehicle.get("id"))] = \
+                        vehicle.get("lane").rpartition("_")[0]
+                    for line in malformed:
+                        file.write(line + "\n")
+                    malformed = ()
+                elem.clear()
+
+    return edges
+
+
+def get_times(timesteps):
+    """Get the times and entry counts of timesteps."""
+    return [(time, len(entries)) for time, entries in timesteps]
+
+
+def test_entries_keep_lane_index(tmp_path):
+    """Entries have the edge and lane index of the lane, also when cached."""
+
+    lanes = [vehicle.get("lane") for _, elem in ET.iterparse(SIMULATION)
+        if elem.tag == "timestep" for vehicle in elem]
+
+    for loader in (XmlDataLoader(SIMULATION),
+        cache_simulation(SIMULATION, str(tmp_path))):
+        assert ["{}_{}".format(entry.edge_id, entry.lane_id)
+            for _, entries in loader.read() for entry in entries] == lanes
+
+
+def test_cache_written_whole(tmp_path):
+    """Concurrent and repeated conversions only ever expose complete caches."""
+
+    filename = tmp_path / "kennedy.output.xml"
+    shutil.copy(SIMULATION, filename)
+    cache_dir = tmp_path / "cache"
+    expected = get_times(XmlDataLoader(SIMULATION).read())
+
+    with ThreadPoolExecutor(4) as executor:
+        loaders = list(executor.map(lambda _: cache_simulation(str(filename),
+            str(cache_dir)), range(4)))
+    assert all(get_times(loader.read()) == expected for loader in loaders)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # an outdated cache is replaced, loaders reading it keep working
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert get_times(cache_simulation(str(filename), str(cache_dir)).read()) \
+        == expected
+    assert get_times(loaders[0].read()) == expected
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_live_loader_is_abstract():
+    """Live loaders need a subclass providing their timesteps."""
+
+    with pytest.raises(TypeError):
+        LiveDataLoader()
+
+
+def test_tail_loader_reads_again():
+    """Each read of a live loader starts over, also after stopping early."""
+
+    expected = get_times(XmlDataLoader(SIMULATION).read())
+    loader = TailDataLoader(SIMULATION, idle_timeout=0.5)
+
+    assert get_times(loader.read()) == expected
+    assert get_times(loader.read()) == expected
+
+    # a read closed early stops its reader before the next one starts
+    timesteps = loader.read()
+    assert get_times(itertools.islice(timesteps, 3)) == expected[:3]
+    timesteps.close()
+    assert get_times(loader.read()) == expected
+
+
+def test_probe_loader_skips_malformed_rows(tmp_path):
+    """Rows with missing or extra fields are left out and counted."""
+
+    model = RoadNetworkModel(os.path.join(ROOT, "ui", "data", "networks"),
+        "kennedy.net.xml")
+    edges = write_probes(tmp_path / "clean.csv")
+    write_probes(tmp_path / "malformed.csv",
+        ["5.0;extra;car;1.0;0;0;1", "5.0;short", "", "5.0"])
+
+    clean = ProbeDataLoader(str(tmp_path / "clean.csv"), model, chunk_size=50)
+    malformed = ProbeDataLoader(str(tmp_path / "malformed.csv"), model,
+        chunk_size=50)
+
+    expected = [(time, [(entry.id, entry.edge_id, entry.pos)
+        for entry in entries]) for time, entries in clean.read()]
+    matched = [edges[(time, _id)] == edge_id
+        for time, entries in expected for _id, edge_id, _ in entries]
+    assert len(expected) > 1
+    assert len(matched) > 0.8 * len(edges)
+    assert sum(matched) > 0.8 * len(matched)
+    assert [(time, [(entry.id, entry.edge_id, entry.pos)
+        for entry in entries]) for time, entries in malformed.read()] \
+        == expected
+    assert (clean.malformed, malformed.malformed) == (0, 3)
@@ -0,0 +1,99 @@
+"""Tests of the background analysis service."""
+
+import os, sys, time, shutil
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ROOT)
+from model.network import RoadNetworkModel
+from analyzer.service import MAX_JOBS, Job, AnalysisService, run_analysis
+
+
+PCE = {"car": 1, "moto": 0.5, "truck": 3.5, "bus": 3.5, "taxi": 1,
+    "other": 1}
+
+
+@pytest.fixture
+def simulation(tmp_path):
+    """The kennedy sample simulation, copied to a temporary directory."""
+
+    filename = tmp_path / "kennedy.output.xml"
+    shutil.copy(os.path.join(ROOT, "ui", "data", "simulations",
+        "kennedy.output.xml"), filename)
+    return str(filename)
+
+
+@pytest.fixture
+def model():
+    """The kennedy sample road network model."""
+    return RoadNetworkModel(os.path.join(ROOT, "ui", "data", "networks"),
+        "kennedy.net.xml")
+
+
+def get_finished_job():
+    """Get a job that is already done."""
+
+    job = Job("session", None, {"progress": 1, "cancelled": False})
+    job.status = "done"
+    return job
+
+
+def wait(job, timeout = 60):
+    """Wait for a job to finish, return its status."""
+
+    end = time.monotonic() + timeout
+    while not job.finished() and time.monotonic() < end:
+        time.sleep(0.05)
+
+    return job.status
+
+
+def test_cancelled_job_does_not_start(model, simulation, tmp_path):
+    """Jobs cancelled while queued return before doing any work."""
+
+    state = {"progress": 0, "cancelled": True}
+    key = ("kennedy.net.xml", "kennedy.output.xml", {"obs_rate": 2})
+
+    assert not run_analysis(model, simulation, str(tmp_path), key, PCE, 2,
+        state)
+    assert "started" not in state
+    assert not os.path.exists(tmp_path / "metrics.db")
+
+
+def test_job_queued_until_started():
+    """Jobs are only reported running once a worker has started them."""
+
+    job = Job("session", None, {"progress": 0, "cancelled": False})
+    assert job.status == "queued" and not job.finished()
+
+    job.state["started"] = True
+    assert job.status == "running" and not job.finished()
+
+    job.status = "done"
+    assert job.status == "done" and job.finished()
+
+
+def test_finished_jobs_kept_up_to_limit(model, simulation, tmp_path):
+    """Only finished jobs beyond the limit are forgotten, oldest first."""
+
+    service = AnalysisService(workers=1)
+    key = ("kennedy.net.xml", "kennedy.output.xml", {"obs_rate": 2})
+    old = [get_finished_job() for _ in range(150)]
+    service.jobs = {job.id: job for job in old}
+
+    first = service.submit("session", model, simulation, str(tmp_path), key,
+        PCE, 2)
+    assert len(service.jobs) == 151
+    assert wait(first) == "done"
+
+    # beyond the limit, only the oldest finished jobs are dropped
+    for job in [get_finished_job() for _ in range(MAX_JOBS - 141)]:
+        service.jobs[job.id] = job
+    second = service.submit("session", model, simulation, str(tmp_path),
+        key, PCE, 2)
+    assert len(service.jobs) == MAX_JOBS
+    assert not any(job.id in service.jobs for job in old[:11])
+    assert all(job.id in service.jobs for job in old[11:])
+    assert first.id in service.jobs and second.id in service.jobs
+    assert wait(second) == "done"
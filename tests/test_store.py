@@ -0,0 +1,62 @@
+"""Tests of the historical metrics store."""
+
+import os, sys, sqlite3
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ROOT)
+from analyzer.vectorized import METRICS
+from analyzer.store import MetricStore
+
+
+KEY = ("kennedy.net.xml", "kennedy.output.xml", {"obs_rate": 2})
+
+
+def get_results(cycles = 250):
+    """Get metrics of a single route over a number of cycles."""
+    return [(({}, {}, {"1": {metric: float(time) for metric in METRICS}}),
+        float(time)) for time in range(cycles)]
+
+
+def get_stored(store):
+    """Get the stored metrics of the run of the key."""
+
+    run = store.get_run(*KEY)
+    return None if run is None else [(tuple({_id: dict(values)
+        for _id, values in systems.items()} for systems in metrics), time)
+        for metrics, time in store.query(run)]
+
+
+def test_paused_recording_keeps_database_unlocked(tmp_path):
+    """Other writers aren't locked out while a recording waits to resume."""
+
+    store = MetricStore(str(tmp_path / "metrics.db"))
+    recording = store.record(*KEY, get_results())
+    for _ in range(150):
+        next(recording)
+
+    other = MetricStore(str(tmp_path / "metrics.db"))
+    other.connection.execute("PRAGMA busy_timeout=100")
+    try:
+        assert other.create_run("other.net.xml", *KEY[1:]) is not None
+    except sqlite3.OperationalError as error:
+        raise AssertionError("database locked by paused recording") from error
+
+    assert len(list(recording)) == 100
+    assert get_stored(store) == get_results()
+
+
+def test_identical_recordings_keep_first_run(tmp_path):
+    """A run started while an identical one records just passes through."""
+
+    first = MetricStore(str(tmp_path / "metrics.db"))
+    second = MetricStore(str(tmp_path / "metrics.db"))
+
+    recording = first.record(*KEY, get_results())
+    for _ in range(150):
+        next(recording)
+
+    assert list(second.record(*KEY, get_results())) == get_results()
+    assert second.get_run(*KEY) is None
+
+    assert len(list(recording)) == 100
+    assert get_stored(second) == get_results()
@@ -1,14 +1,34 @@
-import sys, os, json
-from flask import Flask, render_template, request
+import sys, os, json, hashlib, uuid
+from collections import OrderedDict
+from flask import (Flask, Response, abort, jsonify, render_template, request,
+    session, stream_with_context, url_for)
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
-from model.network import RoadNetworkModel
-from analyzer.loaders import XmlDataLoader
-from analyzer.analyzer import MOEAnalyzer
+from model.network import load_cached_model
+from analyzer.loaders import cache_simulation
+from analyzer.analyzer import SystemAnalyzer
+from analyzer.vectorized import VectorizedMOEAnalyzer
+from analyzer.store import MetricStore
+from analyzer.service import AnalysisService
+from analyzer.stats import PipelineStats
 
 # os.chdir("..")
 app = Flask(__name__)
-model = None
+app.secret_key = os.urandom(16)
+
+# road network models of the most recently used pages, keyed by a token
+# each page passes along, and the analysis jobs of browser sessions
+MAX_MODELS = 32
+models = OrderedDict()
+service = AnalysisService()
+
+# pipeline stats of the most recent analyses run by this process
+MAX_STATS = 16
+run_stats = OrderedDict()
+
+# recent changes of model paths and groups, to derive runs of earlier ones
+MAX_CHANGES = 256
+changes = OrderedDict()
 
 
 @app.route('/')
@@ -28,12 +48,23 @@ def config():
     hide_internals = request.args.get('hide_internals')
     if hide_internals is None:
         hide_internals = "true"
+
+    # get path enumeration limits, all paths are found by default
+    max_paths = request.args.get('max_paths')
+    if max_paths is None:
+        max_paths = ""
+    lazy_paths = request.args.get('lazy_paths')
+    if lazy_paths is None:
+        lazy_paths = "false"
     
     # one of the valid networks was selected, load it
-    global model
     if selection is not None and selection in networks:
 
-        model = RoadNetworkModel(root, selection, shortest_paths=="true")
+        model = load_cached_model(root, selection,
+            os.path.join(root, os.pardir, "cache"),
+            shortest_paths=shortest_paths=="true",
+            max_paths=int(max_paths) if max_paths else None,
+            lazy_paths=lazy_paths=="true")
         details, edges, paths, groups = load_model(model)
 
     # otherwise load empty values
@@ -44,30 +75,87 @@ def config():
         paths = {}
         groups = {}
 
+    model_id = set_model(model)
+
     return render_template('config.html',
+        model_id=model_id,
         networks=networks,
         shortest_paths=shortest_paths,
         hide_internals=hide_internals,
+        max_paths=max_paths,
+        lazy_paths=lazy_paths,
         simulations=simulations,
         details=details,
         edges=edges,
         paths=paths,
-        groups=groups)
+        routes=get_routes(model),
+        groups=groups,
+        geometry_url=model and url_for('geometry', network=model.name,
+            v=model.cache_key))
 
 
-@app.route('/add_edge_group', methods=['POST'])
-def add_edge_group():
-    """Add a custom group to the road network model."""
-    
+@app.route('/groups', methods=['POST'])
+def add_group():
+    """Add a custom group to the road network model, return its details.
+
+    Only the new group is sent back, for the page to add it to its list.
+    Metrics of earlier analyses are kept, the group's own are calculated
+    when they are next requested.
+    """
 
     # check if a model actually exists
-    global model
+    model = get_model()
     if model is None:
-        return config()
+        abort(404)
 
     # add new group to model
-    group = request.get_json()
-    model.add_custom_system(group['name'], group['edges'])
+    parameters = request.get_json()
+    if not parameters.get('edges') or any(edge_id not in model.edge_systems
+        for edge_id in parameters['edges']):
+        abort(400)
+
+    previous = get_systems_digest(model)
+    group = model.add_custom_system(parameters['name'], parameters['edges'])
+    add_change(model, previous, added=[(2, group)])
+
+    return jsonify({"id": group.id, "name": group.name,
+        **model.get_summary('group', group)}), 201
+
+
+@app.route('/groups/<int:group_id>', methods=['DELETE'])
+def remove_group(group_id):
+    """Remove a custom group from the road network model."""
+
+    model = get_model()
+    if model is None or group_id not in model.custom_systems:
+        abort(404)
+
+    # the entire network group is built in, metrics default to showing it
+    if group_id == 0:
+        abort(400)
+
+    previous = get_systems_digest(model)
+    model.remove_custom_system(group_id)
+    add_change(model, previous, removed=[(2, group_id)])
+
+    return jsonify({"id": group_id})
+
+
+@app.route('/add_route', methods=['POST'])
+def add_route():
+    """Find the paths of a route and add them to the road network model."""
+
+    # check if a model actually exists
+    model = get_model()
+    if model is None:
+        return config()
+
+    # add the route's paths to model
+    route = request.get_json()
+    previous = get_systems_digest(model)
+    paths = model.add_route(route['route'])
+    add_change(model, previous,
+        added=[(1, system) for system in paths.values()])
 
     # re-load model details, networks and simulations for display
     details, edges, paths, groups = load_model(model)
@@ -75,101 +163,445 @@ def add_edge_group():
     _, simulations = list_files("data/simulations")
 
     return render_template('config.html',
+        model_id=request.args['model'],
         networks=networks,
         shortest_paths=model.shortest_paths,
         simulations=simulations,
         details=details,
         edges=edges,
         paths=paths,
-        groups=groups)
+        routes=get_routes(model),
+        groups=groups,
+        geometry_url=url_for('geometry', network=model.name,
+            v=model.cache_key))
+
+
+@app.route('/geometry/<network>')
+def geometry(network):
+    """Get the projected edge shapes of a road network as GeoJSON.
+
+    Shapes only depend on the network, not on the page showing it, so they
+    can be cached by the browser and are revalidated by the model cache key.
+    A bbox parameter (west, south, east, north) limits them to the edges
+    crossing a map viewport.
+    """
+
+    model = get_network_model(network)
+    if model is None:
+        abort(404)
+
+    if model.cache_key is not None and model.cache_key in request.if_none_match:
+        return Response(status=304)
+
+    # only edges in the bounding box, found through the spatial index
+    if 'bbox' in request.args:
+        try:
+            west, south, east, north = map(float,
+                request.args['bbox'].split(','))
+        except ValueError:
+            abort(400)
+        edges = set(model.edges_in_bounds(west, south, east, north))
+        response = jsonify({"type": "FeatureCollection",
+            "features": [feature for feature in model.geometry['features']
+                if feature['id'] in edges]})
+    else:
+        response = jsonify(model.geometry)
+
+    if model.cache_key is not None:
+        response.set_etag(model.cache_key)
+        response.cache_control.private = True
+        response.cache_control.max_age = 86400
+
+    return response
 
 
 @app.route('/metrics')
 def metrics():
-    """Show the resulting metrics view."""
+    """Show the resulting metrics view, metric values are streamed later."""
 
     # get analysis parameters and existing simulations
     root, simulations = list_files("data/simulations/")
     parameters = request.args
     
     # check if model and simulation actually exist
-    global model
-
+    model = get_model()
     if (model is None or 'simulation' not in parameters
         or parameters['simulation'] not in simulations):
         return config()
 
+    # load model and metric details for display
+    details, edges, paths, groups = load_model(model)
+    metrics = {
+        "pit": "Percent incomplete trips",
+        "thr": "Throughput",
+        "td": "Total Delay",
+        "dpt": "Delay per trip",
+        "tti": "Travel time index"}
+
+    return render_template('metrics.html',
+        metrics=metrics,
+        edges=edges,
+        paths=paths,
+        groups=groups,
+        geometry_url=url_for('geometry', network=model.name,
+            v=model.cache_key),
+        stream_url=url_for('metrics_stream', **parameters),
+        simulation=parameters['simulation'],
+        hide_internals=parameters['hide_internals'])
+
+
+@app.route('/metrics_stream')
+def metrics_stream():
+    """Stream the metrics of every cycle as soon as they are available.
+
+    Metrics of runs calculated before are read from the metric store, and
+    can be limited to a time window with the start and end parameters. The
+    resolution parameter selects a rollup of them instead, or the points
+    parameter the finest rollup that fits in that many points.
+    """
+
+    # get analysis parameters and existing simulations
+    root, simulations = list_files("data/simulations/")
+    parameters = request.args
+    start = parameters.get('start', type=float)
+    end = parameters.get('end', type=float)
+    resolution = parameters.get('resolution', type=int)
+    points = parameters.get('points', type=int)
+
+    # check if model and simulation actually exist
+    model = get_model()
+    if (model is None or 'simulation' not in parameters
+        or parameters['simulation'] not in simulations):
+        abort(404)
+
+    # query stored results, or derive them from those of an earlier version
+    # of the model's paths and groups, or calculate them, storing both
+    # while they're streamed
+    store = MetricStore(os.path.join(root, os.pardir, "cache", "metrics.db"))
+    key = get_run_key(model, root, parameters)
+    run = store.get_run(*key)
+    if run is not None:
+        if resolution is None:
+            resolution = store.get_resolution(run, start, end, points)
+        results = store.query(run, start, end, resolution=resolution)
+    else:
+        results = derive_results(store, model, root, parameters, key)
+    if results is None:
+        analyzer = get_analyzer(model, root, parameters)
+
+        # rollups are aggregated while recording, and sent instead of the
+        # cycles if those don't fit in the points
+        if resolution is None:
+            resolution = get_live_resolution(analyzer, start, end, points)
+        results = store.record(*key, analyzer.get_next_metrics(),
+            resolution=resolution)
+
+        # keep the analysis stats, readable while it runs
+        run_stats[uuid.uuid4().hex] = (key, analyzer.stats)
+        while len(run_stats) > MAX_STATS:
+            run_stats.popitem(last=False)
+
+    return stream_results(store, results, start, end)
+
+
+@app.route('/stats')
+def stats():
+    """Get the pipeline stats of recent analyses and of the session's jobs.
+
+    Stage times, throughput and cycle latencies are reported for the
+    metric streams calculated by this process, and for the jobs of the
+    current session as last reported by their workers.
+    """
+
+    runs = [{"id": run_id, "network": key[0], "simulation": key[1],
+            "config": key[2], **run.to_dict()}
+        for run_id, (key, run) in list(run_stats.items())]
+
+    jobs = [{"id": job.id, "status": job.status, **job.stats()}
+        for job in service.list(session.get('id'))]
+
+    return jsonify({"runs": runs, "jobs": jobs})
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Start analyzing a simulation in the background, return the job."""
+
+    # get analysis parameters and existing simulations
+    root, simulations = list_files("data/simulations/")
+    parameters = request.get_json()
+
+    # check if model and simulation actually exist
+    model = get_model()
+    if (model is None or 'simulation' not in parameters
+        or parameters['simulation'] not in simulations):
+        abort(404)
+
+    job = service.submit(get_session_id(), model,
+        os.path.join(root, parameters['simulation']),
+        os.path.join(root, os.pardir, "cache"),
+        get_run_key(model, root, parameters), get_pce(parameters),
+        float(parameters['obs_rate']))
+
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+def job(job_id):
+    """Get the status and progress of a job, or cancel it."""
+
+    job = service.get(session.get('id'), job_id)
+    if job is None:
+        abort(404)
 
-    # load data and run the MOE analyzer
-    pce = {"car": float(parameters['pce_car']),
+    if request.method == 'DELETE':
+        service.cancel(job)
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/results')
+def job_results(job_id):
+    """Stream the stored metrics of a finished job.
+
+    Takes the same start, end, resolution and points parameters as the
+    metrics stream.
+    """
+
+    job = service.get(session.get('id'), job_id)
+    if job is None or job.status != "done":
+        abort(404)
+
+    parameters = request.args
+    start = parameters.get('start', type=float)
+    end = parameters.get('end', type=float)
+    resolution = parameters.get('resolution', type=int)
+    points = parameters.get('points', type=int)
+
+    # query the results stored by the job
+    root, _ = list_files("data/simulations/")
+    store = MetricStore(os.path.join(root, os.pardir, "cache", "metrics.db"))
+    run = store.get_run(*job.key)
+    if run is None:
+        store.close()
+        abort(404)
+
+    if resolution is None:
+        resolution = store.get_resolution(run, start, end, points)
+
+    return stream_results(store,
+        store.query(run, start, end, resolution=resolution), start, end)
+
+
+def stream_results(store, results, start, end):
+    """Stream metrics in a time window as JSON lines, then close the store."""
+
+    def generate():
+        """Serialize each cycle's metrics as a single JSON line."""
+
+        try:
+            for metrics, time in results:
+
+                # whole runs are stored, but only the window is sent
+                if ((start is None or time >= start)
+                    and (end is None or time <= end)):
+                    yield json.dumps({"time": time, "edges": metrics[0],
+                        "paths": metrics[1], "groups": metrics[2]}) + "\n"
+
+        finally:
+            store.close()
+
+    return Response(stream_with_context(generate()),
+        mimetype='application/x-ndjson')
+
+
+def get_model():
+    """Get the road network model of the page sending the request.
+
+    Pages pass the token of their model as the model parameter, so pages
+    of the same browser session don't share one.
+    """
+
+    model_id = request.args.get('model')
+    model = models.get(model_id)
+    if model is not None:
+        models.move_to_end(model_id)
+
+    return model
+
+
+def get_network_model(network):
+    """Get a model of a road network, of a page or from the model cache."""
+
+    for model in reversed(list(models.values())):
+        if model.name == network:
+            return model
+
+    root, networks = list_files("data/networks/")
+    if network not in networks:
+        return None
+
+    # with the config view's default options, shapes are the same for all
+    return load_cached_model(root, network,
+        os.path.join(root, os.pardir, "cache"), shortest_paths=True,
+        max_paths=None, lazy_paths=False)
+
+
+def set_model(model):
+    """Keep the road network model of a new page, return its token."""
+
+    if model is None:
+        return None
+
+    # keep the models of the most recently used pages only
+    model_id = uuid.uuid4().hex
+    models[model_id] = model
+    while len(models) > MAX_MODELS:
+        models.popitem(last=False)
+
+    return model_id
+
+
+def get_session_id():
+    """Get the id of the current browser session, which owns its jobs."""
+
+    if 'id' not in session:
+        session['id'] = uuid.uuid4().hex
+
+    return session['id']
+
+
+def get_pce(parameters):
+    """Get the pce value of each vehicle class from request parameters."""
+
+    return {"car": float(parameters['pce_car']),
         "moto": float(parameters['pce_moto']),
         "truck": float(parameters['pce_truck']),
         "bus": float(parameters['pce_bus']),
         "taxi": float(parameters['pce_taxi']),
         "other": float(parameters['pce_other'])}
-    loader = XmlDataLoader(os.path.join(root, parameters['simulation']))
-    analyzer = MOEAnalyzer(model, loader, pce, float(parameters['obs_rate']))
 
 
-    history = {0: {}, 1: {}, 2: {}}
-    times = []
+def get_analyzer(model, root, parameters):
+    """Create a MOE analyzer for a simulation with request parameters."""
 
-    # go through entire observation time, calculate metrics and store them
-    for metrics, time in analyzer.get_next_metrics():
+    # load data and create the MOE analyzer
+    loader = cache_simulation(os.path.join(root, parameters['simulation']),
+        os.path.join(root, os.pardir, "cache"))
 
-        # perform this for edges, paths and groups
-        for i in [0, 1, 2]:
-        
-            # store system metric results keyed by system id then by metric
-            for _id, values in metrics[i].items():
-                
-                # if adding this system for the first time, add metric lists
-                if _id not in history[i]:
-                    history[i][_id] = {}
+    # counters are kept by the analyzer, not on the page's shared model
+    return VectorizedMOEAnalyzer(model, loader, get_pce(parameters),
+        float(parameters['obs_rate']), stats=PipelineStats())
 
-                    # insert first values to each metric list
-                    for metric, value in values.items():
-                        history[i][_id][metric] = [{"y": value, "x": time}]
 
-                # if system has been added
-                else:
-                    # append new values to each metric list
-                    for metric, value in values.items():
-                        history[i][_id][metric].append({"y":value,"x":time})
+def get_live_resolution(analyzer, start, end, points):
+    """Find the rollup resolution to stream a new analysis with.
 
-            # also keep track of time
-            times.append(time)
+    Like MetricStore.get_resolution, from the cycles the analyzer will
+    calculate in the time window.
+    """
 
-    # serialize final metrics into JSON
-    for i in [0, 1, 2]:
-        for _id, values in history[i].items():
-            history[i][_id] = json.dumps(values)
+    times = analyzer.loader.times
+    if points is None or not len(times):
+        return None
 
+    first = float(times[0]) if start is None else max(float(times[0]), start)
+    last = float(times[-1]) if end is None else min(float(times[-1]), end)
+    count = int((last - first) / analyzer.calc_rate) + 1 if last >= first \
+        else 0
 
-    # insert calculated metric values to db
-    # self.db.insert(edge_metrics, path_metrics, group_metrics)
+    return MetricStore.choose_resolution(count, first, last, points)
 
-    # load model and metric details for display
-    details, edges, paths, groups = load_model(model)
-    metrics = {
-        "pit": "Percent incomplete trips",
-        "thr": "Throughput",
-        "td": "Total Delay",
-        "dpt": "Delay per trip",
-        "tti": "Travel time index"}
 
-    return render_template('metrics.html',
-        metrics=metrics,
-        edges=edges,
-        paths=paths,
-        groups=groups,
-        edge_metrics=history[0],
-        path_metrics=history[1],
-        group_metrics=history[2],
-        start_time=times[0],
-        end_time=times[len(times)-1],
-        simulation=parameters['simulation'],
-        hide_internals=parameters['hide_internals'])
+def get_systems_digest(model):
+    """Get a digest of the paths and groups of a model.
+
+    These can change after it's loaded, so runs of the same network are
+    told apart by it.
+    """
+
+    systems = [[str(system.id), sorted(system.edges)] for system
+        in list(model.path_systems.values())
+        + list(model.custom_systems.values())]
+
+    return hashlib.sha256(json.dumps(systems).encode()).hexdigest()[:16]
+
+
+def get_run_key(model, root, parameters):
+    """Get the metric store key of an analysis with request parameters."""
+
+    # simulation file version, same as used for its columnar cache
+    stat = os.stat(os.path.join(root, parameters['simulation']))
+
+    config = {"pce": get_pce(parameters),
+        "obs_rate": float(parameters['obs_rate']),
+        "systems": get_systems_digest(model),
+        "source": [stat.st_size, stat.st_mtime]}
+
+    return model.name, parameters['simulation'], config
+
+
+def add_change(model, previous, removed = (), added = ()):
+    """Record a change of a model's paths and groups since a digest.
+
+    Removed systems are (kind, id) and added ones (kind, system) pairs,
+    with the kind as in the metric store (1 for paths, 2 for groups).
+    """
+
+    changes[(model.name, get_systems_digest(model))] = (previous,
+        list(removed), list(added))
+    while len(changes) > MAX_CHANGES:
+        changes.popitem(last=False)
+
+
+def derive_results(store, model, root, parameters, key):
+    """Derive the results of a request from those of an earlier model version.
+
+    Recorded changes are followed back to a version of the model's paths
+    and groups with a stored run, which is copied without the removed
+    systems, and the simulation is replayed for the added ones only.
+    Returns the results, stored as they're streamed, or None if there is
+    no such earlier run.
+    """
+
+    network, simulation, config = key
+    digest = config["systems"]
+    history = []
+
+    # find the latest earlier version with a stored run
+    while True:
+        change = changes.get((network, digest))
+        if change is None or len(history) == len(changes):
+            return None
+
+        history.append(change)
+        digest = change[0]
+        run = store.get_run(network, simulation, dict(config, systems=digest))
+        if run is not None:
+            break
+
+    # net change since then, systems added and removed again don't count
+    removed = set()
+    added = {}
+    for _, change_removed, change_added in reversed(history):
+        for system in change_removed:
+            if added.pop(system, None) is None:
+                removed.add(system)
+        for kind, system in change_added:
+            added[(kind, system.id)] = system
+
+    analyzer = SystemAnalyzer(model, cache_simulation(os.path.join(root,
+            simulation), os.path.join(root, os.pardir, "cache")),
+        get_pce(parameters), float(parameters['obs_rate']),
+        paths=[system for (kind, _), system in added.items() if kind == 1],
+        groups=[system for (kind, _), system in added.items() if kind == 2],
+        stats=PipelineStats())
+    run_stats[uuid.uuid4().hex] = (key, analyzer.stats)
+    while len(run_stats) > MAX_STATS:
+        run_stats.popitem(last=False)
+
+    return store.derive(run, *key, removed=removed,
+        results=analyzer.get_next_metrics())
 
 
 def list_files(path=""):
@@ -193,30 +625,24 @@ def list_files(path=""):
             pass # TODO throw exception here
 
 
+def get_routes(model):
+    """Get the routes whose paths were not found yet, in lazy models."""
+
+    if model is None or not model.lazy_paths:
+        return []
+
+    return [(route_id, route_id.replace("->", u"\u2192 "))
+        for route_id in sorted(model.routes)
+        if route_id not in model.loaded_routes]
+
+
 def load_model(model):
     """Handle necessary actions for model loading"""
 
-    # load all edges in the network
-    edges_dict = {}
-    for edge in model.edges.values():
-
-        # project edge shapes to original lat/lng coordinates
-        new_shape = edge.shape.transform(model.convBoundary,
-            model.origBoundary)
-
-        # edge dtails
-        edges_dict[edge.id] = {
-            'id': edge.id,
-            'order': edge.shape.get_center()[0],   # order by latitude
-            'shape': str(new_shape),
-            'type': edge.type,
-            'lanes': len(edge.lanes),
-            'speed': round(edge.flow_speed * 3.6),
-            'length': edge.length
-        }
-
-    # sort edges by the order provided, get as list of tuples
-    edges = sorted(edges_dict.items(), key=lambda x: x[1]['order'])
+    # load edge details from the projected geometry, sorted by latitude
+    edges = sorted(((feature['id'], dict(feature['properties'],
+            id=feature['id'])) for feature in model.geometry['features']),
+        key=lambda x: x[1]['order'])
 
     # load all path systems in the network
     paths_dict = {}
@@ -226,10 +652,7 @@ def load_model(model):
         paths_dict[path.id] = {
             'name': path.name.replace("->", u"\u2192 "),
             'order': path.name,  # order by name
-            'length': round(sum(system.edge.length
-                for system in path.edge_systems.values()),1),
-            'edges': ','.join(str(system.edge.id)
-                for system in path.edge_systems.values())
+            **model.get_summary('path', path)
         }
 
     # sort paths by the order provided, get as list of tuples
@@ -243,10 +666,7 @@ def load_model(model):
         groups_dict[group.id] = {
             'name': group.name,
             'order': group.name,  # order by name
-            'length': round(sum(system.edge.length
-                for system in group.edge_systems.values()),1),
-            'edges': ','.join(str(system.edge.id)
-                for system in group.edge_systems.values())
+            **model.get_summary('group', group)
         }
 
     # sort paths by the order provided, get as list of tuples
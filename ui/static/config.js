@@ -9,6 +9,8 @@ function config_load_handler() {
     $('#network').change(reload_config)
     $('#shortest_paths').change(reload_config)
     $('#hide_internals').change(reload_config)
+    $('#max_paths').change(reload_config)
+    $('#lazy_paths').change(reload_config)
 
     // hide simulation parameters when no simulation is selected
     $('#simulation').change(function(){
@@ -24,20 +26,23 @@ function config_load_handler() {
     map = get_map("roadMap")
     if(map){
 
-        // read edges and draw the road network map
-        edges_bounds = read_edges()
-        map.draw(edges_bounds[0], edges_bounds[1])
+        // fetch edges and draw the road network map
+        read_edges(function(edges, bounds){
+            map.draw(edges, bounds)
 
-        // set the table's behavior
-        set_behavior('edges-tab')
-        $('.content ul.tabs li').click(function(){
-            deselect_all()
-            set_behavior($(this).attr('data-tab'))
-        })
+            // set the table's behavior
+            set_behavior('edges-tab')
+            $('.content ul.tabs li').click(function(){
+                deselect_all()
+                set_behavior($(this).attr('data-tab'))
+            })
+
+            // common deselection button
+            $('.desel_all').click(function(){
+                deselect_all()
+            })
 
-        // common deselection button
-        $('.desel_all').click(function(){
-            deselect_all()
+            window.dispatchEvent(new Event('map_drawn'))
         })
     }
 
@@ -56,6 +61,12 @@ function reload_config(){
     if($("#hide_internals").length){
         parameters['hide_internals'] = $("#hide_internals").is(":checked")
     }
+    if($("#max_paths").length){
+        parameters['max_paths'] = $("#max_paths").val()
+    }
+    if($("#lazy_paths").length){
+        parameters['lazy_paths'] = $("#lazy_paths").is(":checked")
+    }
 
     $.get("/config", 
         parameters,
@@ -69,6 +80,13 @@ function reload_config(){
 }
 
 
+function get_model_id(){
+// get the token of this page's road network model, sent with its requests
+
+    return $('nav.config-view').attr('data-model-id')
+}
+
+
 function get_map(element='map', center=[0,0], zoom=10,
     colors={'default': "black", 'highlighted': "red", 'selected': "blue"}){
 // get a new map object instance if possible
@@ -94,33 +112,35 @@ function get_map(element='map', center=[0,0], zoom=10,
 }
 
 
-function read_edges(){
-// Read edge data attributes and return them as an array
+function read_edges(callback){
+// Fetch the projected edge geometry, pass edges and bounds to callback
 
-    var edges = {}
-    var lats = []
-    var lngs = []
+    $.getJSON($("#roadMap").attr("data-geometry-url"), function(geometry){
 
-    $('.edge').each(function(){
+        var edges = {}
+        var lats = []
+        var lngs = []
 
-        // get edge id, number of lanes and shape
-        id = $(this).attr("data-edge-id")
-        lanes = $(this).attr("data-edge-lanes")
-        shapestr = $(this).attr("data-edge-shape").split(" ")
-        shape = shapestr.map(x => x.split(",").reverse())
+        geometry.features.forEach(function(feature){
 
-        // store latitude, longitude values separately for bounds calculation
-        lats.push(shape[0][0])
-        lngs.push(shape[0][1])
-        
-        edges[id] = {'id': id, 'shape': shape, 'lanes': lanes}
-    })
+            // get edge id, number of lanes and shape (GeoJSON is lng, lat)
+            id = feature.id
+            lanes = feature.properties.lanes
+            shape = feature.geometry.coordinates.map(x => [x[1], x[0]])
 
-    // calculate bounding box corner coordinates
-    var bounds = [[Math.min(...lats), Math.min(...lngs)],
-        [Math.max(...lats), Math.max(...lngs)]]
+            // store latitude, longitude values separately for bounds
+            lats.push(shape[0][0])
+            lngs.push(shape[0][1])
 
-    return [edges, bounds]
+            edges[id] = {'id': id, 'shape': shape, 'lanes': lanes}
+        })
+
+        // calculate bounding box corner coordinates
+        var bounds = [[Math.min(...lats), Math.min(...lngs)],
+            [Math.max(...lats), Math.max(...lngs)]]
+
+        callback(edges, bounds)
+    })
 }
 
 
@@ -138,6 +158,7 @@ function set_behavior(tab_id) {
     $('.edge').off()
     $('.path').off()
     $('.group').off()
+    $('.remove_group').off()
     map.off()
 
     if (tab_id == "edges-tab") {
@@ -330,6 +351,11 @@ function path_list_behavior() {
         reset_selections()
     })
 
+    // find the paths of a route not yet loaded
+    $('.route .find_paths').click(function(){
+        add_route($(this).closest('.route').attr("data-route-id"))
+    })
+
     // add group button listener
     $('#group_paths_btn').click(function(){
 
@@ -458,6 +484,12 @@ function group_list_behavior() {
         reset_selections()
     })
 
+    // remove a group, without selecting it
+    $('.remove_group').on('click', function(ev){
+        ev.stopPropagation()
+        remove_group($(this).closest('.group').attr("data-group-id"))
+    })
+
     // select all groups
     $('#sel_all_groups').click(function(){
         $('.group').addClass("selected")
@@ -500,24 +532,79 @@ function add_group(name, edges){
         reset_selections()
         
         $.post({
-            url: "/add_edge_group",
+            url: "/groups?" + $.param({"model": get_model_id()}),
             data: JSON.stringify({'name': name, 'edges': edges}),
             contentType: "application/json; charset=utf-8",
-            dataType: "html",
-            success: function( data ) {
-                var custom_groups = $(data).find('#groups-tab');
-                $("#groups-tab").html(custom_groups.first().html());
-                $(document).ready(config_load_handler)
+            dataType: "json",
+            success: function( group ) {
+
+                // add only the new group's row, keeping the list sorted
+                var row = $('<tr class="group">')
+                    .attr("data-group-id", group.id)
+                    .attr("data-group-edges", group.edges)
+                    .append($('<td>').text(group.name))
+                    .append($('<td>').text(group.length + " m"))
+                    .append($('<td>').append(
+                        $('<button class="remove_group">Remove</button>')))
+
+                var next = $('#groups-tab .group').filter(function(){
+                    return $(this).children().first().text() > group.name
+                }).first()
+                if (next.length) {
+                    row.insertBefore(next)
+                } else {
+                    $('#groups-tab tbody').append(row)
+                }
+
+                set_behavior(
+                    $('.content ul.tabs li.current').attr('data-tab'))
             }})
     }
 }
 
 
+function remove_group(group_id){
+// Remove a custom group from the model
+
+    $.ajax({
+        url: "/groups/" + group_id + "?"
+            + $.param({"model": get_model_id()}),
+        type: "DELETE",
+        dataType: "json",
+        success: function( group ) {
+            $(`.group[data-group-id="${group.id}"]`).remove()
+            reset_selections()
+            set_behavior($('.content ul.tabs li.current').attr('data-tab'))
+        }})
+}
+
+
+function add_route(route){
+// Find the paths of a route and add them to the model
+
+    $('.selected').removeClass("selected")
+    reset_selections()
+
+    $.post({
+        url: "/add_route?" + $.param({"model": get_model_id()}),
+        data: JSON.stringify({'route': route}),
+        contentType: "application/json; charset=utf-8",
+        dataType: "html",
+        success: function( data ) {
+            var paths = $(data).find('#paths-tab');
+            $("#paths-tab").html(paths.first().html());
+            $("#paths").html($(data).find('#paths').first().html());
+            set_behavior('paths-tab')
+        }})
+}
+
+
 function load_metrics(){
 // reload the entire metrics page
 
     $.get("/metrics", 
-        {'simulation': $('#simulation').val(),
+        {'model': get_model_id(),
+        'simulation': $('#simulation').val(),
         'obs_rate': $("#obs_rate").val(),
         'pce_car': $("#pce_car").val(),
         'pce_moto': $("#pce_moto").val(),
@@ -1,5 +1,10 @@
 $(document).ready(metrics_load_handler)
 
+// charts are redrawn while streaming, waiting longer between redraws the
+// longer they take, so redrawing all data doesn't add up to O(n^2) work
+var MIN_REDRAW_DELAY = 500      // milliseconds
+var REDRAW_DELAY_FACTOR = 10    // times the duration of the last redraw
+
 
 // function responsible for all metrics actions after page load
 function metrics_load_handler() {
@@ -23,20 +28,31 @@ function metrics_load_handler() {
         })
         
 
-        // set the entire network as the default element
-        set_behavior('groups-tab')
+        // set the entire network as the default element, its edges are
+        // selected on the map once that is drawn
         $('.metrics-view tr[data-group-id="0"]').addClass('selected')
-        reset_selections()
         update_panels()
+        window.addEventListener('map_drawn', function(){
+            set_behavior('groups-tab')
+            reset_selections()
+        })
 
         // bind listeners for parameters/selections changed by user
         window.addEventListener('selection_changed', update_panels)
         $(".metric-checkbox").click(function(){ update_panels() })
         $("#beta").change(function(){
-            draw_charts( 1 - $(this).val() )
+            window.beta = 1 - $(this).val()
+            draw_charts(window.beta)
+        })
+
+        // zoom into a time window, stored results are queried for it
+        $("#time_start, #time_end").change(function(){
+            stream_metrics(get_stream_url())
         })
 
-        draw_charts(1)
+        // draw charts as metric values arrive from the backend
+        window.beta = 1
+        stream_metrics(get_stream_url())
     }
 }
 
@@ -45,6 +61,133 @@ function update_panels(){
 
     update_selections()
     update_metrics()
+    draw_charts(window.beta)
+}
+
+
+function get_stream_url(){
+// Get the metrics stream URL for the selected time window
+
+    var url = $('nav.metrics-view').attr('data-stream-url')
+    var start = $("#time_start").val()
+    var end = $("#time_end").val()
+
+    if (start !== "") { url += "&start=" + start }
+    if (end !== "") { url += "&end=" + end }
+
+    // stored results are rolled up to about one point per chart pixel
+    return url + "&points=" + Math.round($("#roadMap").first().width())
+}
+
+
+function stream_metrics(url){
+// Read cycle metrics line by line while the backend calculates them
+
+    window.datasets = {'edges': {}, 'paths': {}, 'groups': {}}
+    window.time_range = null
+    var decoder = new TextDecoder()
+    var buffer = ""
+    var redraw = null
+    var redraw_delay = MIN_REDRAW_DELAY
+
+    // stop reading any earlier stream, e.g. of a different time window
+    if (window.stream_reader) {
+        window.stream_reader.cancel()
+        window.stream_reader = null
+    }
+
+    fetch(url).then(function(response){
+        var reader = response.body.getReader()
+        window.stream_reader = reader
+
+        function read_chunk(){
+            return reader.read().then(function(result){
+
+                // ignore chunks of streams that were replaced
+                if (reader !== window.stream_reader) {
+                    clearTimeout(redraw)
+                    return
+                }
+
+                // split received text in complete lines, keep the remainder
+                if (result.value) {
+                    buffer += decoder.decode(result.value, {stream: true})
+                }
+                var lines = buffer.split("\n")
+                buffer = lines.pop()
+                lines.forEach(function(line){
+                    if (line) {
+                        append_metrics(JSON.parse(line))
+                    }
+                })
+
+                // draw the final charts once the stream ends
+                if (result.done) {
+                    clearTimeout(redraw)
+                    draw_charts(window.beta)
+                    return
+                }
+
+                // otherwise redraw once the delay since the last one passed
+                if (redraw === null && window.time_range !== null) {
+                    redraw = setTimeout(function(){
+                        var start = performance.now()
+                        draw_charts(window.beta)
+                        redraw_delay = Math.max(MIN_REDRAW_DELAY,
+                            (performance.now() - start) * REDRAW_DELAY_FACTOR)
+                        redraw = null
+                    }, redraw_delay)
+                }
+
+                return read_chunk()
+            })
+        }
+
+        return read_chunk()
+    })
+}
+
+
+function append_metrics(cycle){
+// Append the metric values of a single cycle to every system's dataset
+
+    // extend the common time range
+    if (window.time_range === null) {
+        window.time_range = [cycle.time, cycle.time]
+    } else {
+        window.time_range[1] = cycle.time
+    }
+
+    // perform this for edges, paths and groups
+    Object.keys(window.datasets).forEach(function(kind){
+        var systems = window.datasets[kind]
+
+        Object.keys(cycle[kind]).forEach(function(system_id){
+            var values = cycle[kind][system_id]
+
+            // if adding this system for the first time, add metric lists
+            if (!(system_id in systems)) {
+                systems[system_id] = {}
+                Object.keys(values).forEach(function(metric){
+                    systems[system_id][metric] = []
+                })
+            }
+
+            // append new values to each metric list, rollups of stored
+            // results also have the range of values in their period
+            Object.keys(values).forEach(function(metric){
+                var value = values[metric]
+
+                if (typeof value === 'object') {
+                    systems[system_id][metric].push({"x": cycle.time,
+                        "y": value.mean, "min": value.min, "max": value.max})
+                } else {
+                    systems[system_id][metric].push(
+                        {"x": cycle.time, "y": value})
+                }
+            })
+        })
+    })
 }
 
 function update_selections(){
@@ -91,6 +234,11 @@ function update_metrics(){
 
 function draw_charts(beta){
 
+    // nothing to draw before the first values arrive
+    if (typeof window.datasets === 'undefined' || window.time_range === null){
+        return
+    }
+
     var margin = {top: 20, right: 10, bottom: 20, left: 40}
 
     // get the width of any graph that isn't hidden
@@ -99,40 +247,22 @@ function draw_charts(beta){
 
     // get common chart X scale
     var xScale = d3.scaleLinear()
-        .domain([
-            $(".metrics-view").attr("data-time-start"),
-            $(".metrics-view").attr("data-time-end")]) // input
+        .domain(window.time_range) // input
         .range([0, width]); // output
 
 
-    // draw all edge charts
-    $("tr.edge").each(function(){
-
-        // get the id and metric values for this edge
-        var edge_id = $(this).attr("data-edge-id")
-        var dataset = JSON.parse($(this).attr("data-edge-metrics"))
+    // draw the charts of all edges, paths and groups that are shown
+    Object.keys(window.datasets).forEach(function(kind){
+        var systems = window.datasets[kind]
 
-        draw_chart(edge_id, dataset, margin, width, height, xScale, beta)        
-    })
-
-    // draw all path charts
-    $("tr.path").each(function(){
-
-        // get the id and metric values for this path
-        var path_id = $(this).attr("data-path-id")
-        var dataset = JSON.parse($(this).attr("data-path-metrics"))
-
-        draw_chart(path_id, dataset, margin, width, height, xScale, beta)
-    })
+        Object.keys(systems).forEach(function(system_id){
+            var panel = $(`.graph-panel[data-system-id="${system_id}"]`)
 
-    // draw all group charts
-    $("tr.group").each(function(){
-
-        // get the id and metric values for this group
-        var group_id = $(this).attr("data-group-id")
-        var dataset = JSON.parse($(this).attr("data-group-metrics"))
-
-        draw_chart(group_id, dataset, margin, width, height, xScale, beta)        
+            if (panel.length > 0 && !panel.hasClass("hidden")) {
+                draw_chart(system_id, systems[system_id], margin, width,
+                    height, xScale, beta)
+            }
+        })
     })
 
 }
@@ -144,7 +274,7 @@ function draw_chart(system_id, dataset, margin, width, height, xScale, beta){
     Object.keys(dataset).forEach(function(metric) {
 
         var peak = Math.max(...dataset[metric].map(function(d){
-                return d["y"]
+                return "max" in d ? d["max"] : d["y"]
             }))
 
         // Y scale will is based on maximum values
@@ -187,6 +317,19 @@ function draw_chart(system_id, dataset, margin, width, height, xScale, beta){
             .attr("class", "y axis")
             .call(d3.axisLeft(yScale).ticks(5));
 
+        // for rollups, shade the range between min and max values
+        if (dataset[metric].length > 0 && "max" in dataset[metric][0]) {
+            var area = d3.area()
+                .x(function(d) { return xScale(d.x); })
+                .y0(function(d) { return yScale(d.min); })
+                .y1(function(d) { return yScale(d.max); })
+
+            svg.append("path")
+                .datum(dataset[metric])
+                .attr("class", "range")
+                .attr("d", area);
+        }
+
         // Append the path, bind the data, and call the line generator 
         svg.append("path")
             .datum(dataset[metric])